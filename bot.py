@@ -1,10 +1,25 @@
+import time
+STARTED_AT = time.perf_counter()  # отсчёт холодного старта — до всех остальных импортов
+
 import logging
 import io
 import os
 import json
 import re
-
-from PIL import Image, ImageDraw, ImageFont
+import csv
+import math
+import asyncio
+import ast
+import tempfile
+import sqlite3
+import heapq
+import contextlib
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
 
 from telegram import (
     Update,
@@ -12,17 +27,23 @@ from telegram import (
     ReplyKeyboardRemove,
     KeyboardButton,
     InputMediaPhoto,
-    Contact
+    InlineKeyboardButton,
+    InlineKeyboardMarkup
 )
 from telegram.ext import (
     Application,
     CommandHandler,
+    CallbackQueryHandler,
     MessageHandler,
     filters,
     ConversationHandler,
-    ContextTypes
+    ContextTypes,
+    ApplicationHandlerStop,
+    BaseRateLimiter,
+    TypeHandler
 )
-from telegram.request import HTTPXRequest
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest, HTTPXRequest
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -80,100 +101,426 @@ AUTH, MENU, GET_NAME, GET_PHONE, GET_ADDRESS = range(5)
 EDIT_CHOICE, EDIT_FIELD, EDIT_VALUE, DELETE_CHOICE, DELETE_CONFIRM = range(23, 28)
 CHECK_MEASURE = 28
 
+# Имена состояний по номеру — для логов и файлов профилей
+STATE_NAMES = {value: name for name, value in list(globals().items())
+               if isinstance(value, int) and 0 <= value <= CHECK_MEASURE}
+
+# -------------------------------------------------------------------
+# 2.1) РАЗБОР РАЗМЕРОВ И ИТОГИ ПО МАТЕРИАЛАМ
+# Размеры, добор и количества вводятся текстом; здесь они переводятся
+# в числа и за один проход по проёмам суммируются для сводки.
+# -------------------------------------------------------------------
+DIMENSIONS_HINT = "Введите три числа в мм: высота, ширина, толщина стены. Например: 2050 810 120"
+HEIGHT_RANGE_MM = (1000, 3500)
+WIDTH_RANGE_MM = (300, 3000)
+WALL_RANGE_MM = (30, 600)
+NALICHNIKI_PER_SET = 2.5   # один комплект — 2,5 планки на сторону проёма
+
+def parse_number(text) -> float:
+    """Первое число из строки ("1,5", "100 мм"); None, если числа нет."""
+    match = re.search(r"\d+(?:[.,]\d+)?", str(text or ""))
+    if not match:
+        return None
+    return float(match.group(0).replace(",", "."))
+
+def parse_dimensions(text: str) -> tuple:
+    """
+    "2050 810 120", "2050х810х120", "2,05*0,81*0,12" → (2050, 810, 120) в мм.
+    При ошибке выбрасывает ValueError с текстом для пользователя.
+    """
+    values = [float(v.replace(",", ".")) for v in re.findall(r"\d+(?:[.,]\d+)?", text or "")]
+    if len(values) != 3:
+        raise ValueError(f"Нужно три числа, получено: {len(values)}. {DIMENSIONS_HINT}")
+    # Метры и сантиметры приводим к миллиметрам
+    if max(values) < 10:
+        values = [v * 1000 for v in values]
+    elif max(values) < 400:
+        values = [v * 10 for v in values]
+    height, width, wall = (int(round(v)) for v in values)
+    for value, (low, high), name in (
+        (height, HEIGHT_RANGE_MM, "Высота"),
+        (width, WIDTH_RANGE_MM, "Ширина"),
+        (wall, WALL_RANGE_MM, "Толщина стены"),
+    ):
+        if not low <= value <= high:
+            raise ValueError(f"{name} {value} мм вне допустимого диапазона {low}–{high} мм. {DIMENSIONS_HINT}")
+    return height, width, wall
+
+def format_qty(value: float) -> str:
+    return f"{value:g}".replace(".", ",")
+
+def compute_materials_summary(openings: list) -> dict:
+    """Один проход по проёмам: полотна по размерам, доборы, наличники, пороги."""
+    canvases = {}
+    dobor = {}
+    nalichniki = 0.0
+    thresholds = 0
+    demontage = 0
+    unparsed = []
+    for i, op in enumerate(openings, start=1):
+        try:
+            height, width, _ = parse_dimensions(op["dimensions"])
+        except ValueError:
+            height = width = None
+            unparsed.append(i)
+        canvas = str(op["canvas"]).strip()
+        if canvas and canvas != "---" and op["door_type"] != "Облагораживание проема":
+            canvases[canvas] = canvases.get(canvas, 0) + 1
+        dobor_width = parse_number(op["dobor"])
+        if dobor_width:
+            key = str(int(dobor_width))
+            entry = dobor.setdefault(key, {"count": 0.0, "length_mm": 0})
+            entry["count"] += parse_number(op["dobor_count"]) or 0.0
+            if height and width:
+                # Две стойки по высоте и перемычка по ширине
+                entry["length_mm"] += 2 * height + width
+        nalichniki += parse_number(op["nalichniki"]) or 0.0
+        if str(op["threshold"]).strip().lower() == "да":
+            thresholds += 1
+        if str(op["demontage"]).strip().lower() == "да":
+            demontage += 1
+    return {
+        "openings": len(openings),
+        "canvases": canvases,
+        "dobor": dobor,
+        "nalichniki": nalichniki,
+        "nalichniki_sets": round(nalichniki / NALICHNIKI_PER_SET, 1),
+        "thresholds": thresholds,
+        "demontage": demontage,
+        "unparsed_dimensions": unparsed,
+    }
+
+def format_materials_summary(summary: dict) -> list:
+    lines = ["Итого по замеру:"]
+    if summary["canvases"]:
+        lines.append("Полотна: " + "; ".join(
+            f"{size} — {count} шт" for size, count in sorted(summary["canvases"].items())
+        ))
+    if summary["dobor"]:
+        parts = []
+        for width, entry in sorted(summary["dobor"].items(), key=lambda item: int(item[0])):
+            part = f"{width} мм — {format_qty(entry['count'])} шт"
+            if entry["length_mm"]:
+                part += f" ({format_qty(round(entry['length_mm'] / 1000, 2))} м.п.)"
+            parts.append(part)
+        lines.append("Доборы: " + "; ".join(parts))
+    if summary["nalichniki"]:
+        lines.append(
+            f"Наличники: {format_qty(summary['nalichniki'])} шт "
+            f"({format_qty(summary['nalichniki_sets'])} компл.)"
+        )
+    lines.append(f"Пороги: {summary['thresholds']} шт; демонтаж: {summary['demontage']} шт")
+    if summary["unparsed_dimensions"]:
+        lines.append("Размеры не распознаны в проёмах: " + ", ".join(map(str, summary["unparsed_dimensions"])))
+    return lines
+
+# -------------------------------------------------------------------
+# 2.2) ПРОЁМ
+# Компактная запись проёма со __slots__ вместо словаря на 12 ключей. Доступ
+# op["room"] / op.get(...) оставлен, чтобы обработчики и архив работали как
+# раньше; поле "photo" («есть»/«нет») вычисляется, поэтому перед рендером
+# проёмы больше не копируются. to_dict/from_dict — представление для
+# хранения: через них проёмы пишутся в архив и читаются обратно.
+# -------------------------------------------------------------------
+OPENING_FIELDS = [
+    "room", "door_type", "dimensions", "canvas",
+    "dobor", "dobor_count", "nalichniki",
+    "threshold", "demontage", "opening", "comment"
+]
+OPENING_DEFAULTS = {
+    "room": "", "door_type": "", "dimensions": "", "canvas": "---",
+    "dobor": "---", "dobor_count": "---", "nalichniki": "---",
+    "threshold": "", "demontage": "", "opening": "---", "comment": ""
+}
+
+class Opening:
+    __slots__ = tuple(OPENING_FIELDS) + ("photos", "photo_uids")
+
+    def __init__(self, photos=None, photo_uids=None, **values):
+        for field in OPENING_FIELDS:
+            setattr(self, field, values.pop(field, OPENING_DEFAULTS[field]))
+        if values:
+            raise TypeError(f"Неизвестные поля проёма: {', '.join(values)}")
+        self.photos = list(photos or [])
+        self.photo_uids = list(photo_uids) if photo_uids else [None] * len(self.photos)
+
+    @property
+    def photo(self) -> str:
+        return "есть" if self.photos else "нет"
+
+    def __getitem__(self, key: str):
+        if key not in self.__slots__ and key != "photo":
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Opening":
+        return cls(**{key: value for key, value in data.items() if key in cls.__slots__})
+
+    def __repr__(self) -> str:
+        return f"Opening({self.to_dict()!r})"
+
 # -------------------------------------------------------------------
 # 3) ФУНКЦИЯ ГЕНЕРАЦИИ PNG (ТАБЛИЦЫ) + ЛОГОТИП
 # -------------------------------------------------------------------
+# Pillow импортируется при первой отрисовке, а шрифты и логотип загружаются
+# один раз и переиспользуются: перезапуск контейнера не платит за них до
+# первого замера (или их заранее прогревает prewarm_renderer).
+FONT_PATH = "Montserrat-Regular.ttf"
+LOGO_PATH = "Logo_rusdver.png"
+
+@lru_cache(maxsize=None)
+def load_font(size: int):
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except Exception as e:
+        logging.error("Ошибка загрузки шрифта: %s", e)
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=1)
+def load_logo():
+    from PIL import Image
+    try:
+        logo = Image.open(LOGO_PATH).convert("RGBA")
+        logo.thumbnail((150, 9999))
+        return logo
+    except Exception as e:
+        logging.error("Ошибка загрузки логотипа: %s", e)
+        return None
+
+def prewarm_renderer():
+    started = time.perf_counter()
+    load_font(16)
+    load_font(24)
+    load_logo()
+    generate_measurement_image({"openings": []})
+    logging.info("Рендер прогрет за %.0f мс", (time.perf_counter() - started) * 1000)
+
+TABLE_HEADERS = [
+    "№", "Комната", "Тип двери", "Размеры", "Полотно",
+    "Добор", "Кол-во доборов", "Наличники",
+    "Порог", "Демонтаж", "Открывание", "Комментарий"
+]
+
+# Ширины колонок подбираются по содержимому: сначала каждая колонка
+# получает ширину самого длинного слова, затем ширина отдаётся той колонке,
+# которая сильнее всего уменьшает площадь таблицы (меньше переносов — ниже
+# строки), пока площадь убывает и общая ширина не превышает TABLE_MAX_WIDTH.
+# Ширина строки считается как сумма ширин слов и пробелов: измерение целой
+# строки шрифтом стоит миллисекунды, а сумма никогда не меньше реальной
+# ширины, так что текст не вылезает из ячейки. Для каждой ячейки один раз
+# строятся пороги ширины, на которых уменьшается число строк; поиск идёт по
+# ним шагами TABLE_WIDTH_STEP и ограничен TABLE_LAYOUT_MAX_STEPS шагами.
+TABLE_FONT_SIZE = 16
+TABLE_CELL_PADDING = 10
+TABLE_LINE_SPACING = 5
+TABLE_MAX_WIDTH = int(os.environ.get("TABLE_MAX_WIDTH", "1520"))
+TABLE_WIDTH_STEP = 10
+TABLE_LAYOUT_MAX_STEPS = 200
+
+@lru_cache(maxsize=8192)
+def measure_text(text: str, size: int) -> tuple:
+    left, top, right, bottom = load_font(size).getbbox(text)
+    return (right - left, bottom - top)
+
+@lru_cache(maxsize=None)
+def space_width(size: int) -> float:
+    return load_font(size).getlength(" ")
+
+def word_widths(words: list, size: int) -> list:
+    return [measure_text(word, size)[0] for word in words]
+
+def wrap_words(widths: list, max_width: float, space: float) -> tuple:
+    """Жадный перенос по ширинам слов: индексы начала строк и наименьшая
+    ширина, при которой перенос изменится (inf — уже одна строка)."""
+    starts = [0]
+    line = widths[0]
+    next_width = float("inf")
+    for i, width in enumerate(widths[1:], start=1):
+        if line + space + width <= max_width:
+            line += space + width
+        else:
+            next_width = min(next_width, line + space + width)
+            starts.append(i)
+            line = width
+    return starts, next_width
+
+@lru_cache(maxsize=8192)
+def wrap_text(text: str, max_width: int, size: int = TABLE_FONT_SIZE) -> tuple:
+    words = text.split()
+    if not words:
+        return ("",)
+    starts, _ = wrap_words(word_widths(words, size), max_width, space_width(size))
+    return tuple(" ".join(words[a:b]) for a, b in zip(starts, starts[1:] + [len(words)]))
+
+def line_breakpoints(text: str, size: int) -> tuple:
+    """Пороги переноса ячейки: (ширины, число строк) по возрастанию ширины —
+    начиная с widths[k] текст занимает lines[k] строк."""
+    words = text.split()
+    if not words:
+        return [0], [1]
+    widths = word_widths(words, size)
+    space = space_width(size)
+    thresholds, lines = [], []
+    width = max(widths)
+    while True:
+        starts, next_width = wrap_words(widths, width, space)
+        if not lines or len(starts) < lines[-1]:
+            thresholds.append(width)
+            lines.append(len(starts))
+        if next_width == float("inf"):
+            return thresholds, lines
+        width = next_width
+
+def layout_columns(rows: list, min_total: int = 0, fixed_height: int = 0, size: int = TABLE_FONT_SIZE) -> list:
+    """Ширины колонок под содержимое rows. min_total и fixed_height — ширина и
+    высота остальной части картинки (шапка, итоги), чтобы минимизировалась
+    площадь всего изображения, а не одной таблицы."""
+    from bisect import bisect_right
+    padding = TABLE_CELL_PADDING
+    line_height = measure_text("A", size)[1] + TABLE_LINE_SPACING
+    columns = [[line_breakpoints(cell, size) for cell in cells] for cells in zip(*rows)]
+    widths = [math.ceil(max(t[0] for t, _ in cells)) + 2 * padding for cells in columns]
+    max_widths = [math.ceil(max(t[-1] for t, _ in cells)) + 2 * padding for cells in columns]
+    # Колонки, слова которых шире лимита, не сжимаются — такие слова всё равно не перенести
+    budget = max(TABLE_MAX_WIDTH, sum(widths))
+
+    def line_counts(c, width):
+        return [lines[bisect_right(t, width - 2 * padding) - 1] for t, lines in columns[c]]
+
+    def next_width(c, width):
+        # Ближайшая ширина на сетке TABLE_WIDTH_STEP, где хоть одна ячейка колонки
+        # теряет строку
+        inner = width - 2 * padding
+        target = min((t[i] for t, _ in columns[c] for i in [bisect_right(t, inner)] if i < len(t)),
+                     default=None)
+        if target is None:
+            return None
+        steps = math.ceil((target - inner) / TABLE_WIDTH_STEP)
+        return min(width + steps * TABLE_WIDTH_STEP, max_widths[c])
+
+    def image_area(counts, total_width):
+        height = sum(max(row) for row in zip(*counts)) * line_height + len(rows) * 3 * padding
+        return max(total_width, min_total) * (height + fixed_height)
+
+    counts = [line_counts(c, width) for c, width in enumerate(widths)]
+    area = image_area(counts, sum(widths))
+    for _ in range(TABLE_LAYOUT_MAX_STEPS):
+        best = None
+        for c in range(len(columns)):
+            width = next_width(c, widths[c])
+            if width is None or sum(widths) - widths[c] + width > budget:
+                continue
+            candidate_counts = counts[:c] + [line_counts(c, width)] + counts[c + 1:]
+            candidate = image_area(candidate_counts, sum(widths) - widths[c] + width)
+            if candidate < area and (best is None or candidate < best[0]):
+                best = (candidate, c, width, candidate_counts)
+        if best is None:
+            break
+        area, c, widths[c], counts = best
+    return widths
+
+# Превью для замерщика: та же отрисовка, уменьшенная до PREVIEW_MAX_WIDTH и
+# сведённая к палитре из PREVIEW_COLORS цветов. Чёрный текст на белом JPEG
+# почти не сжимает, а палитра уменьшает PNG в 3–5 раз; меньшие размеры в
+# пикселях уменьшают и то, что Telegram отдаёт на телефон. Полное PNG уходит
+# только в рабочий чат.
+PREVIEW_MAX_WIDTH = int(os.environ.get("PREVIEW_MAX_WIDTH", "1024"))
+PREVIEW_COLORS = int(os.environ.get("PREVIEW_COLORS", "16"))
+
 def generate_measurement_image(client_data: dict) -> io.BytesIO:
-    col_widths = [50, 150, 200, 200, 100, 100, 110, 110, 80, 100, 120, 200]
-    headers = [
-        "№", "Комната", "Тип двери", "Размеры", "Полотно",
-        "Добор", "Кол-во доборов", "Наличники",
-        "Порог", "Демонтаж", "Открывание", "Комментарий"
-    ]
+    return encode_table_png(draw_measurement_table(client_data))
+
+def generate_measurement_images(client_data: dict) -> tuple:
+    """Полное PNG и лёгкое превью из одной отрисовки таблицы."""
+    img = draw_measurement_table(client_data)
+    return encode_table_png(img), encode_table_preview(img)
+
+def encode_table_png(img) -> io.BytesIO:
+    bio = io.BytesIO()
+    bio.name = "zamery.png"
+    img.save(bio, "PNG")
+    bio.seek(0)
+    return bio
+
+def encode_table_preview(img) -> io.BytesIO:
+    from PIL import Image
+    if img.width > PREVIEW_MAX_WIDTH:
+        img = img.resize((PREVIEW_MAX_WIDTH, max(1, img.height * PREVIEW_MAX_WIDTH // img.width)), Image.LANCZOS)
+    bio = io.BytesIO()
+    bio.name = "zamery_preview.png"
+    img.quantize(PREVIEW_COLORS).save(bio, "PNG", optimize=True)
+    bio.seek(0)
+    return bio
+
+def draw_measurement_table(client_data: dict):
+    headers = TABLE_HEADERS
     openings = client_data.get("openings", [])
     rows = [headers]
     for i, op in enumerate(openings, start=1):
         row = [
             str(i),
-            op["room"],
-            op["door_type"],
-            op["dimensions"],
-            op["canvas"],
-            op["dobor"],
-            op["dobor_count"],
-            op["nalichniki"],
-            op["threshold"],
-            op["demontage"],
-            op["opening"],
-            op["comment"]
+            op.room,
+            op.door_type,
+            op.dimensions,
+            op.canvas,
+            op.dobor,
+            op.dobor_count,
+            op.nalichniki,
+            op.threshold,
+            op.demontage,
+            op.opening,
+            op.comment
         ]
-        rows.append(row)
+        rows.append([str(cell) for cell in row])
     client_info = (
         f"Имя: {client_data.get('client_name', '')}\n"
         f"Телефон: {client_data.get('client_phone', '')}\n"
         f"Адрес: {client_data.get('client_address', '')}\n"
     )
-    try:
-        font = ImageFont.truetype("Montserrat-Regular.ttf", 16)
-    except Exception as e:
-        logging.error("Ошибка загрузки шрифта: %s", e)
-        font = ImageFont.load_default()
-    temp_img = Image.new("RGB", (10, 10))
-    draw_temp = ImageDraw.Draw(temp_img)
-    def get_text_size(text, font_obj):
-        left, top, right, bottom = draw_temp.textbbox((0, 0), text, font=font_obj)
-        return (right - left, bottom - top)
-    def wrap_text(text, max_width):
-        words = text.split()
-        lines = []
-        if not words:
-            return [""]
-        current_line = words[0]
-        for w in words[1:]:
-            test_line = current_line + " " + w
-            w_test, _ = get_text_size(test_line, font)
-            if w_test <= max_width:
-                current_line = test_line
-            else:
-                lines.append(current_line)
-                current_line = w
-        lines.append(current_line)
-        return lines
-    cell_padding = 10
-    line_spacing = 5
-    row_lines = []
-    row_heights = []
-    for row_idx, row_data in enumerate(rows):
-        max_height = 0
-        row_lines.append([])
-        for col_idx, cell_text in enumerate(row_data):
-            cell_text = str(cell_text)
-            effective_width = col_widths[col_idx] - 2 * cell_padding
-            lines = wrap_text(cell_text, effective_width)
-            _, line_h = get_text_size("A", font)
-            line_height_with_spacing = line_h + line_spacing
-            cell_height = len(lines) * line_height_with_spacing + 3 * cell_padding
-            if cell_height > max_height:
-                max_height = cell_height
-            row_lines[row_idx].append(lines)
-        row_heights.append(max_height)
+    from PIL import Image, ImageDraw
+    font = load_font(TABLE_FONT_SIZE)
+    cell_padding = TABLE_CELL_PADDING
+    line_spacing = TABLE_LINE_SPACING
+    _, line_h = measure_text("A", TABLE_FONT_SIZE)
+    line_height_with_spacing = line_h + line_spacing
     margin = 50
-    table_width = sum(col_widths) + margin * 2
     info_lines = client_info.strip().split("\n")
-    _, line_h = get_text_size("A", font)
     info_block_height = line_h * len(info_lines) + 40
-    logo_path = "Logo_rusdver.png"
-    try:
-        logo = Image.open(logo_path).convert("RGBA")
-        logo.thumbnail((150, 9999))
-        logo_width, logo_height = logo.size
-    except Exception as e:
-        logging.error("Ошибка загрузки логотипа: %s", e)
-        logo = None
-        logo_width, logo_height = 0, 0
+    logo = load_logo()
+    logo_width, logo_height = logo.size if logo else (0, 0)
     top_block_height = max(info_block_height, logo_height) + 20
+    summary_lines = format_materials_summary(compute_materials_summary(openings))
+    summary_height = len(summary_lines) * (line_h + line_spacing) + 20
+    # Узкая таблица не должна обрезать данные клиента, логотип и итоги
+    text_width = max(measure_text(line, TABLE_FONT_SIZE)[0] for line in info_lines + summary_lines)
+    text_width += logo_width + margin if logo else 0
+    col_widths = layout_columns(rows, text_width, top_block_height + summary_height + margin * 2)
+    row_lines = []
+    row_heights = []
+    for row_data in rows:
+        lines_in_row = [wrap_text(cell_text, col_widths[col_idx] - 2 * cell_padding)
+                        for col_idx, cell_text in enumerate(row_data)]
+        row_lines.append(lines_in_row)
+        row_heights.append(max(len(lines) for lines in lines_in_row) * line_height_with_spacing + 3 * cell_padding)
     table_height = sum(row_heights) + margin * 2
-    total_height = top_block_height + table_height
+    table_width = max(sum(col_widths), text_width) + margin * 2
+    total_height = top_block_height + table_height + summary_height
     img = Image.new("RGB", (table_width, total_height), color="white")
     draw = ImageDraw.Draw(img)
     y_offset = 20
@@ -193,35 +540,128 @@ def generate_measurement_image(client_data: dict) -> io.BytesIO:
             lines = row_lines[row_idx][col_idx]
             text_x = x_offset + cell_padding
             text_y = y_offset + cell_padding
-            _, line_h = get_text_size("A", font)
-            line_height_with_spacing = line_h + line_spacing
             for line in lines:
                 draw.text((text_x, text_y), line, font=font, fill="black")
                 text_y += line_height_with_spacing
             x_offset += w_col
         y_offset += row_h
-    bio = io.BytesIO()
-    bio.name = "zamery.png"
-    img.save(bio, "PNG")
-    bio.seek(0)
-    return bio
+    y_offset += 20
+    for line in summary_lines:
+        draw.text((margin, y_offset), line, font=font, fill="black")
+        y_offset += line_h + line_spacing
+    return img
 
 # -------------------------------------------------------------------
 # 4) ФУНКЦИИ ДЛЯ НАЛОЖЕНИЯ ПОДПИСЕЙ НА ФОТО И ОТПРАВКИ АЛЬБОМА
 # -------------------------------------------------------------------
-FONT_PATH = "Montserrat-Regular.ttf"
-
-async def overlay_text_on_photo(context: ContextTypes.DEFAULT_TYPE, file_id: str, text: str) -> io.BytesIO:
-    temp_path = "temp_photo.jpg"
-    telegram_file = await context.bot.get_file(file_id)
-    await telegram_file.download_to_drive(temp_path)
-    img = Image.open(temp_path).convert("RGBA")
-    draw = ImageDraw.Draw(img)
+# Рендер (Pillow) выполняется в пуле потоков, чтобы не останавливать цикл событий:
+# пока один замерщик ждёт отрисовку, остальные продолжают получать ответы.
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "2"))
+RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+async def run_in_render_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    token = object()
+    render_jobs[token] = time.monotonic()
     try:
-        font = ImageFont.truetype(FONT_PATH, 24)
-    except Exception as e:
-        logging.error("Ошибка загрузки шрифта overlay: %s", e)
-        font = ImageFont.load_default()
+        return await loop.run_in_executor(RENDER_EXECUTOR, func, *args)
+    finally:
+        del render_jobs[token]
+
+def draw_photo_overlay(photo_bytes: bytes, text: str) -> io.BytesIO:
+    return draw_photo_overlays(photo_bytes, [text])[0]
+
+# Ограничение памяти на обработку фото. Картинки больше IMAGE_MAX_PIXELS не
+# декодируются вовсе; больше IMAGE_DECODE_MAX_PIXELS — декодируются сразу в
+# уменьшенном масштабе (для JPEG через draft, без полного растра). Параллельные
+# задачи резервируют оценку занимаемых байт из общего бюджета
+# IMAGE_MEMORY_BUDGET_MB, поэтому пиковая память не зависит от того, сколько
+# огромных фото пришло одновременно.
+IMAGE_MAX_PIXELS = int(os.environ.get("IMAGE_MAX_PIXELS", "60000000"))
+IMAGE_DECODE_MAX_PIXELS = int(os.environ.get("IMAGE_DECODE_MAX_PIXELS", "12000000"))
+IMAGE_MEMORY_BUDGET_MB = float(os.environ.get("IMAGE_MEMORY_BUDGET_MB", "256"))
+
+class MemoryBudget:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.waiting = 0
+        self.condition = None   # создаётся в работающем цикле событий (Python 3.9)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, nbytes: int):
+        # Задача больше всего бюджета выполняется одна, а не ждёт вечно
+        nbytes = min(nbytes, self.limit)
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            self.waiting += 1
+            try:
+                await self.condition.wait_for(lambda: self.used + nbytes <= self.limit)
+            finally:
+                self.waiting -= 1
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.used -= nbytes
+                self.condition.notify_all()
+
+    def snapshot(self) -> dict:
+        return {
+            "reserved_mb": round(self.used / 1024 / 1024, 1),
+            "budget_mb": round(self.limit / 1024 / 1024, 1),
+            "waiting": self.waiting,
+        }
+
+IMAGE_MEMORY = MemoryBudget(int(IMAGE_MEMORY_BUDGET_MB * 1024 * 1024))
+
+def decoded_size(width: int, height: int) -> tuple:
+    pixels = width * height
+    if pixels > IMAGE_MAX_PIXELS:
+        raise ValueError(f"Фото слишком большое: {width}x{height}")
+    if pixels <= IMAGE_DECODE_MAX_PIXELS:
+        return width, height
+    scale = (IMAGE_DECODE_MAX_PIXELS / pixels) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def estimate_overlay_bytes(photo_bytes: bytes, copies: int) -> int:
+    # Читается только заголовок; RGBA-растр + буфер PNG + копии под разные подписи
+    from PIL import Image
+    with Image.open(io.BytesIO(photo_bytes)) as img:
+        full_width, full_height = img.size
+        width, height = decoded_size(full_width, full_height)
+        draftable = img.format == "JPEG"
+    estimate = width * height * 4 * (2 + (copies if copies > 1 else 0))
+    if (width, height) != (full_width, full_height):
+        if draftable:
+            # draft декодирует не меньше целевого размера — до 2 раз по каждой стороне
+            estimate += min(full_width * full_height, 4 * width * height) * 3
+        else:
+            # PNG/WebP draft не умеют: thumbnail сначала строит полный растр
+            estimate += full_width * full_height * 4
+    return estimate
+
+def open_photo_bounded(photo_bytes: bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(photo_bytes))
+    target = decoded_size(*img.size)
+    if target != img.size:
+        # thumbnail сам включает draft: JPEG декодируется сразу в 1/2, 1/4 или 1/8
+        img.thumbnail(target)
+    return img
+
+def draw_photo_overlays(photo_bytes: bytes, texts: list) -> list:
+    # Одно фото может быть прикреплено к нескольким проёмам: декодируем один раз,
+    # а подпись рисуем на копии для каждого проёма
+    base = open_photo_bounded(photo_bytes).convert("RGBA")
+    return [render_overlay(base.copy() if len(texts) > 1 else base, text) for text in texts]
+
+def render_overlay(img, text: str) -> io.BytesIO:
+    from PIL import ImageDraw
+    draw = ImageDraw.Draw(img)
+    font = load_font(OVERLAY_FONT_SIZE)
     text_x = 20
     text_y = img.height - 60
     text_w, text_h = draw.textsize(text, font=font)
@@ -230,24 +670,691 @@ async def overlay_text_on_photo(context: ContextTypes.DEFAULT_TYPE, file_id: str
     draw.text((text_x, text_y), text, fill=(255, 255, 255, 255), font=font)
     out_buf = io.BytesIO()
     out_buf.name = "photo.png"
-    img.save(out_buf, "PNG")
+    img.save(out_buf, OVERLAY_FORMAT)
     out_buf.seek(0)
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
     return out_buf
 
-from telegram import InputMediaPhoto
+# Кэш готовых фото с подписями на диске. Ключ — (file_unique_id, подпись,
+# настройки кодирования), поэтому повторное завершение после правки и
+# повторная отправка архивного замера не скачивают и не перерисовывают фото.
+# Размер ограничен OVERLAY_CACHE_MAX_MB, вытесняются давно не читанные файлы.
+OVERLAY_FONT_SIZE = 24
+OVERLAY_FORMAT = "PNG"
+OVERLAY_CACHE_DIR = os.environ.get("OVERLAY_CACHE_DIR", "overlay_cache")
+OVERLAY_CACHE_MAX_MB = float(os.environ.get("OVERLAY_CACHE_MAX_MB", "200"))
+
+class OverlayCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None     # имя файла -> [размер, время последнего доступа]
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def key(self, unique_id: str, text: str) -> str:
+        # Предел декодирования меняет разрешение результата — он тоже часть ключа
+        settings = (f"{OVERLAY_FORMAT}:{OVERLAY_FONT_SIZE}:{os.path.basename(FONT_PATH)}:"
+                    f"{IMAGE_DECODE_MAX_PIXELS}")
+        digest = hashlib.sha256(f"{unique_id}\0{text}\0{settings}".encode("utf-8")).hexdigest()
+        return f"{digest}.{OVERLAY_FORMAT.lower()}"
+
+    def load_index(self):
+        # Вызывается под self.lock; индекс строится по файлам, оставшимся с прошлого запуска
+        if self.entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.entries = {}
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    self.entries[entry.name] = [stat.st_size, stat.st_mtime]
+
+    def get(self, unique_id: str, text: str):
+        name = self.key(unique_id, text)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            self.load_index()
+            if name not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            self.entries[name][1] = time.time()
+        try:
+            with open(path, "rb") as f:
+                buf = io.BytesIO(f.read())
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.entries.pop(name, None)
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+        buf.name = "photo.png"
+        return buf
+
+    def get_many(self, unique_id: str, texts: list) -> list:
+        return [self.get(unique_id, text) for text in texts]
+
+    def put(self, unique_id: str, text: str, image: io.BytesIO):
+        name = self.key(unique_id, text)
+        path = os.path.join(self.directory, name)
+        data = image.getvalue()
+        with self.lock:
+            self.load_index()
+        # Пишем во временный файл и переименовываем, чтобы не оставить обрезанный PNG
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error("Не удалось сохранить фото в кэш: %s", e)
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            return
+        with self.lock:
+            self.entries[name] = [len(data), time.time()]
+            self.stats["stores"] += 1
+            self.evict()
+
+    def evict(self):
+        # Вызывается под self.lock
+        total = sum(size for size, _ in self.entries.values())
+        if total <= self.max_bytes:
+            return
+        for name, (size, _) in sorted(self.entries.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.directory, name))
+            del self.entries[name]
+            total -= size
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            entries = self.entries or {}
+            return dict(self.stats, files=len(entries), bytes=sum(size for size, _ in entries.values()))
+
+OVERLAY_CACHE = OverlayCache(OVERLAY_CACHE_DIR, int(OVERLAY_CACHE_MAX_MB * 1024 * 1024))
+
+def draw_photo_overlays_cached(unique_id: str, photo_bytes: bytes, texts: list) -> list:
+    images = draw_photo_overlays(photo_bytes, texts)
+    for text, image in zip(texts, images):
+        OVERLAY_CACHE.put(unique_id, text, image)
+    return images
+
+async def download_photo_bytes(context: ContextTypes.DEFAULT_TYPE, file_id: str) -> bytes:
+    # Скачиваем в память: общий temp-файл на диске ломался при параллельных замерах
+    telegram_file = await context.bot.get_file(file_id)
+    local_path = local_file_path(context.bot, telegram_file.file_path)
+    if local_path:
+        # Локальный сервер Bot API уже сохранил файл на диск: читаем в потоке, без HTTP
+        return await asyncio.to_thread(read_file_bytes, local_path)
+    return bytes(await telegram_file.download_as_bytearray())
+
+async def overlay_text_on_photo(context: ContextTypes.DEFAULT_TYPE, file_id: str, text: str) -> io.BytesIO:
+    return (await overlay_texts_on_photo(context, file_id, [text]))[0]
+
+async def overlay_texts_on_photo(context: ContextTypes.DEFAULT_TYPE, file_id: str, texts: list,
+                                 unique_id: str = None) -> list:
+    if unique_id:
+        # Первое обращение сканирует каталог кэша, а попадание читает PNG с диска —
+        # это не должно останавливать цикл событий
+        images = await asyncio.to_thread(OVERLAY_CACHE.get_many, unique_id, texts)
+    else:
+        images = [None] * len(texts)
+    missing = [i for i, image in enumerate(images) if image is None]
+    if not missing:
+        return images
+    photo_bytes = await download_photo_bytes(context, file_id)
+    missing_texts = [texts[i] for i in missing]
+    async with IMAGE_MEMORY.reserve(estimate_overlay_bytes(photo_bytes, len(missing_texts))):
+        if unique_id:
+            rendered = await run_in_render_pool(draw_photo_overlays_cached, unique_id, photo_bytes, missing_texts)
+        else:
+            rendered = await run_in_render_pool(draw_photo_overlays, photo_bytes, missing_texts)
+    for i, image in zip(missing, rendered):
+        images[i] = image
+    return images
+
+MEDIA_GROUP_LIMIT = 10
+# album — таблица первой карточкой альбома с подписью клиента, за ней фото
+# (меньше запросов, замер не перемешивается с чужими сообщениями в чате);
+# separate — как раньше: таблица отдельным фото, затем альбом с фото;
+# sheet — таблица и контактные листы (см. ниже) одним альбомом
+DELIVERY_MODE = os.environ.get("DELIVERY_MODE", "album")
+
+async def render_photo_overlays(context: ContextTypes.DEFAULT_TYPE, photo_overlays: list) -> list:
+    """photo_overlays — список (file_id, file_unique_id, подпись). Одинаковые фото
+    (по file_unique_id) скачиваются и декодируются один раз."""
+    groups = {}   # file_unique_id -> (file_id, file_unique_id, [(позиция в альбоме, подпись)])
+    for position, (file_id, unique_id, overlay_text) in enumerate(photo_overlays):
+        groups.setdefault(unique_id or file_id, (file_id, unique_id, []))[2].append((position, overlay_text))
+    rendered = await asyncio.gather(*(
+        overlay_texts_on_photo(context, file_id, [text for _, text in items], unique_id)
+        for file_id, unique_id, items in groups.values()
+    ), return_exceptions=True)
+    processed = [None] * len(photo_overlays)
+    for (_, _, items), images in zip(groups.values(), rendered):
+        if isinstance(images, ValueError):
+            # Фото за пределами IMAGE_MAX_PIXELS пропускаем, остальные отправляем
+            logging.error("Фото пропущено: %s", images)
+            continue
+        if isinstance(images, BaseException):
+            raise images
+        for (position, _), image in zip(items, images):
+            processed[position] = image
+    return [image for image in processed if image is not None]
+
+def balanced_chunks(items: list, limit: int) -> list:
+    # Делим поровну: 11 при лимите 10 → 6 + 5, а не 10 + 1
+    if not items:
+        return []
+    chunks = -(-len(items) // limit)
+    size = -(-len(items) // chunks)
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+async def send_media_chunks(context: ContextTypes.DEFAULT_TYPE, chat_id: int, media: list):
+    # В альбоме от 2 до 10 элементов, единственный элемент отправляем обычным фото
+    if not media:
+        return
+    if len(media) == 1:
+        await context.bot.send_photo(chat_id=chat_id, photo=media[0].media, caption=media[0].caption)
+        return
+    for chunk in balanced_chunks(media, MEDIA_GROUP_LIMIT):
+        await context.bot.send_media_group(chat_id=chat_id, media=chunk)
 
 async def send_photos_with_overlay_as_album(context: ContextTypes.DEFAULT_TYPE, chat_id: int, photo_overlays: list):
-    media_group = []
+    processed = await render_photo_overlays(context, photo_overlays)
     album_caption = "Все фото с подписями"
-    for i, (file_id, overlay_text) in enumerate(photo_overlays):
-        processed_img = await overlay_text_on_photo(context, file_id, overlay_text)
-        if i == 0:
-            media_group.append(InputMediaPhoto(processed_img, caption=album_caption))
+    media_group = [
+        InputMediaPhoto(image, caption=album_caption if i == 0 else None) for i, image in enumerate(processed)
+    ]
+    await send_media_chunks(context, chat_id, media_group)
+
+# Контактный лист: все фото замера плитками по SHEET_COLUMNS в ряд, не больше
+# SHEET_MAX_TILES на лист, с теми же подписями «Фото j проёма #i». Замер с
+# десятками фото уходит в чат одной-двумя загрузками вместо нескольких
+# альбомов; фото в полном размере присылает команда /photos <номер>.
+SHEET_COLUMNS = int(os.environ.get("SHEET_COLUMNS", "4"))
+SHEET_MAX_TILES = int(os.environ.get("SHEET_MAX_TILES", "20"))
+SHEET_TILE_SIZE = (480, 360)
+SHEET_GAP = 6
+SHEET_FONT_SIZE = 18
+SHEET_JPEG_QUALITY = 85
+SHEET_BACKGROUND = (40, 40, 40)
+
+def sheet_size(count: int) -> tuple:
+    columns = min(SHEET_COLUMNS, count)
+    rows = -(-count // columns)
+    tile_w, tile_h = SHEET_TILE_SIZE
+    return columns * (tile_w + SHEET_GAP) + SHEET_GAP, rows * (tile_h + SHEET_GAP) + SHEET_GAP
+
+def estimate_sheet_bytes(count: int) -> int:
+    # Лист в RGB + одно фото, декодированное через draft не больше чем в 2 раза крупнее плитки
+    width, height = sheet_size(count)
+    tile_w, tile_h = SHEET_TILE_SIZE
+    return width * height * 3 + (2 * tile_w) * (2 * tile_h) * 4
+
+def draw_sheet_tile(photo_bytes: bytes, text: str):
+    from PIL import Image, ImageDraw
+    tile = Image.new("RGB", SHEET_TILE_SIZE, SHEET_BACKGROUND)
+    try:
+        with Image.open(io.BytesIO(photo_bytes)) as img:
+            decoded_size(*img.size)
+            # JPEG декодируется сразу в масштабе, близком к размеру плитки
+            img.draft("RGB", SHEET_TILE_SIZE)
+            photo = img.convert("RGB")
+        photo.thumbnail(SHEET_TILE_SIZE)
+        tile.paste(photo, ((tile.width - photo.width) // 2, (tile.height - photo.height) // 2))
+    except ValueError as e:
+        # Слишком большое фото остаётся пустой плиткой с подписью
+        logging.error("Фото не попало на лист: %s", e)
+    draw = ImageDraw.Draw(tile, "RGBA")
+    font = load_font(SHEET_FONT_SIZE)
+    _, _, _, text_h = draw.textbbox((0, 0), text, font=font)
+    text_x = 10
+    text_y = tile.height - text_h - 12
+    left, top, right, bottom = draw.textbbox((text_x, text_y), text, font=font)
+    draw.rectangle([left - 6, top - 6, right + 6, bottom + 6], fill=(0, 0, 0, 150))
+    draw.text((text_x, text_y), text, fill=(255, 255, 255, 255), font=font)
+    return tile
+
+def draw_contact_sheet(tiles: list) -> io.BytesIO:
+    """tiles — список (байты фото, подпись); фото декодируются по одному."""
+    from PIL import Image
+    sheet = Image.new("RGB", sheet_size(len(tiles)), SHEET_BACKGROUND)
+    columns = min(SHEET_COLUMNS, len(tiles))
+    tile_w, tile_h = SHEET_TILE_SIZE
+    for index, (photo_bytes, text) in enumerate(tiles):
+        row, column = divmod(index, columns)
+        position = (SHEET_GAP + column * (tile_w + SHEET_GAP), SHEET_GAP + row * (tile_h + SHEET_GAP))
+        sheet.paste(draw_sheet_tile(photo_bytes, text), position)
+    out_buf = io.BytesIO()
+    out_buf.name = "sheet.jpg"
+    sheet.save(out_buf, "JPEG", quality=SHEET_JPEG_QUALITY)
+    out_buf.seek(0)
+    return out_buf
+
+async def render_contact_sheets(context: ContextTypes.DEFAULT_TYPE, photo_overlays: list) -> list:
+    """photo_overlays — как в render_photo_overlays. Листы рисуются по очереди,
+    поэтому в памяти одновременно только фото одного листа."""
+    sheets = []
+    for chunk in balanced_chunks(photo_overlays, SHEET_MAX_TILES):
+        downloads = {}
+        for file_id, unique_id, _ in chunk:
+            downloads.setdefault(unique_id or file_id, file_id)
+        photo_bytes = dict(zip(downloads, await asyncio.gather(
+            *(download_photo_bytes(context, file_id) for file_id in downloads.values())
+        )))
+        tiles = [(photo_bytes[unique_id or file_id], text) for file_id, unique_id, text in chunk]
+        async with IMAGE_MEMORY.reserve(estimate_sheet_bytes(len(tiles))):
+            sheets.append(await run_in_render_pool(draw_contact_sheet, tiles))
+    return sheets
+
+def measurement_photo_overlays(client_data: dict) -> list:
+    photo_overlays = []
+    for i, op in enumerate(client_data.get("openings", []), start=1):
+        for j, (file_id, unique_id) in enumerate(zip(op.photos, op.photo_uids), start=1):
+            overlay_text = f"Фото {j} проёма #{i} ({op.room})"
+            photo_overlays.append((file_id, unique_id, overlay_text))
+    return photo_overlays
+
+async def render_table(client_data: dict, table_image: io.BytesIO = None) -> io.BytesIO:
+    if table_image is not None:
+        return table_image
+    return await run_in_render_pool(generate_measurement_image, client_data)
+
+async def send_measurement(context: ContextTypes.DEFAULT_TYPE, chat_id: int, client_data: dict,
+                           measurement_id: int = None, table_image: io.BytesIO = None):
+    # Таблица + фото с подписями; используется при завершении и повторной отправке.
+    # table_image — уже нарисованная таблица (из фонового рендера), если есть
+    caption_text = (
+        f"Имя: {client_data.get('client_name', '')}\n"
+        f"Телефон: {client_data.get('client_phone', '')}\n"
+        f"Адрес: {client_data.get('client_address', '')}"
+    )
+    photo_overlays = measurement_photo_overlays(client_data)
+    if DELIVERY_MODE == "sheet":
+        if photo_overlays and measurement_id is not None:
+            caption_text += f"\nВсе фото по отдельности: /photos {measurement_id}"
+        image_data, sheets = await asyncio.gather(
+            render_table(client_data, table_image),
+            render_contact_sheets(context, photo_overlays)
+        )
+        media = [InputMediaPhoto(image_data, caption=caption_text)] + [InputMediaPhoto(sheet) for sheet in sheets]
+        await send_media_chunks(context, chat_id, media)
+        return
+    if DELIVERY_MODE != "album":
+        image_data = await render_table(client_data, table_image)
+        await context.bot.send_photo(chat_id=chat_id, photo=image_data, caption=caption_text)
+        if photo_overlays:
+            await send_photos_with_overlay_as_album(context, chat_id, photo_overlays)
+        return
+    # Таблица рисуется, пока скачиваются и подписываются фото
+    image_data, photos = await asyncio.gather(
+        render_table(client_data, table_image),
+        render_photo_overlays(context, photo_overlays)
+    )
+    media = [InputMediaPhoto(image_data, caption=caption_text)] + [InputMediaPhoto(image) for image in photos]
+    await send_media_chunks(context, chat_id, media)
+
+# -------------------------------------------------------------------
+# 4.1) АРХИВ ЗАВЕРШЁННЫХ ЗАМЕРОВ (SQLite)
+# Каждый отправленный замер сохраняется локально: поля клиента, проёмы,
+# file_id фото, замерщик и время. Индексы по телефону, адресу и дате
+# позволяют найти и повторно отправить замер без повторного ввода.
+# -------------------------------------------------------------------
+ARCHIVE_DB_PATH = os.environ.get("ARCHIVE_DB", "archive.db")
+ARCHIVE_FIND_LIMIT = 10
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    installer TEXT NOT NULL DEFAULT '',
+    installer_id INTEGER,
+    client_name TEXT NOT NULL DEFAULT '',
+    client_phone TEXT NOT NULL DEFAULT '',
+    phone_digits TEXT NOT NULL DEFAULT '',
+    client_address TEXT NOT NULL DEFAULT '',
+    address_norm TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_measurements_phone ON measurements(phone_digits);
+CREATE INDEX IF NOT EXISTS idx_measurements_address ON measurements(address_norm);
+CREATE INDEX IF NOT EXISTS idx_measurements_created ON measurements(created_at);
+
+CREATE TABLE IF NOT EXISTS openings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    measurement_id INTEGER NOT NULL REFERENCES measurements(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    room TEXT NOT NULL DEFAULT '',
+    door_type TEXT NOT NULL DEFAULT '',
+    dimensions TEXT NOT NULL DEFAULT '',
+    canvas TEXT NOT NULL DEFAULT '',
+    dobor TEXT NOT NULL DEFAULT '',
+    dobor_count TEXT NOT NULL DEFAULT '',
+    nalichniki TEXT NOT NULL DEFAULT '',
+    threshold TEXT NOT NULL DEFAULT '',
+    demontage TEXT NOT NULL DEFAULT '',
+    opening TEXT NOT NULL DEFAULT '',
+    comment TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_openings_measurement ON openings(measurement_id, position);
+
+CREATE TABLE IF NOT EXISTS photos (
+    opening_id INTEGER NOT NULL REFERENCES openings(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    file_id TEXT NOT NULL,
+    file_unique_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_photos_opening ON photos(opening_id, position);
+
+-- Полнотекстовый индекс по проёмам; rowid совпадает с openings.id
+CREATE VIRTUAL TABLE IF NOT EXISTS openings_fts USING fts5(
+    client_address, room, door_type, dimensions, dobor, comment,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+FTS_COLUMNS = ["client_address", "room", "door_type", "dimensions", "dobor", "comment"]
+SEARCH_PAGE_SIZE = 8
+SEARCH_QUERIES_KEPT = 20   # сколько последних запросов /search листаются кнопками
+ARCHIVE_STATUS_LABELS = {"draft": " · черновик", "pending": " · не отправлен"}
+
+_archive_conn = None
+
+def get_archive() -> sqlite3.Connection:
+    global _archive_conn
+    if _archive_conn is None:
+        conn = sqlite3.connect(ARCHIVE_DB_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(ARCHIVE_SCHEMA)
+        ensure_columns(conn, "measurements", {"summary": "TEXT NOT NULL DEFAULT '{}'", "status": "TEXT NOT NULL DEFAULT 'sent'"})
+        ensure_columns(conn, "openings", {"height_mm": "INTEGER", "width_mm": "INTEGER", "wall_mm": "INTEGER"})
+        ensure_columns(conn, "photos", {"file_unique_id": "TEXT"})
+        sync_search_index(conn)
+        _archive_conn = conn
+    return _archive_conn
+
+def ensure_columns(conn: sqlite3.Connection, table: str, columns: dict):
+    # Простая миграция: добавляем колонки, появившиеся после создания базы
+    existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+def sync_search_index(conn: sqlite3.Connection):
+    # Дозаполняем FTS-индекс проёмами, сохранёнными до его появления
+    indexed = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM openings_fts").fetchone()[0]
+    with conn:
+        conn.execute(
+            f"INSERT INTO openings_fts (rowid, {', '.join(FTS_COLUMNS)}) "
+            "SELECT o.id, m.client_address, o.room, o.door_type, o.dimensions, o.dobor, o.comment "
+            "FROM openings o JOIN measurements m ON m.id = o.measurement_id WHERE o.id > ?",
+            (indexed,)
+        )
+
+def normalize_phone(phone: str) -> str:
+    # Оставляем последние 10 цифр: "8 912 ..." и "+7 912 ..." дают один ключ
+    digits = re.sub(r"\D", "", phone or "")
+    return digits[-10:]
+
+def normalize_address(address: str) -> str:
+    return " ".join((address or "").lower().replace("ё", "е").split())
+
+def archive_measurement(client_data: dict, installer: str = "", installer_id: int = None,
+                        status: str = "sent") -> int:
+    """status: 'sent' — отправленный замер, 'pending' — записан перед отправкой,
+    доставка ещё не подтверждена, 'draft' — брошенный черновик (закрыт по таймауту)."""
+    conn = get_archive()
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    summary = compute_materials_summary(client_data.get("openings", []))
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO measurements (created_at, installer, installer_id, client_name, client_phone, "
+            "phone_digits, client_address, address_norm, summary, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                created_at,
+                installer or "",
+                installer_id,
+                client_data.get("client_name", ""),
+                client_data.get("client_phone", ""),
+                normalize_phone(client_data.get("client_phone", "")),
+                client_data.get("client_address", ""),
+                normalize_address(client_data.get("client_address", "")),
+                json.dumps(summary, ensure_ascii=False),
+                status,
+            )
+        )
+        measurement_id = cur.lastrowid
+        for position, op in enumerate(client_data.get("openings", []), start=1):
+            values = op.to_dict()
+            try:
+                dims = list(parse_dimensions(values["dimensions"]))
+            except ValueError:
+                dims = [None, None, None]
+            cur = conn.execute(
+                f"INSERT INTO openings (measurement_id, position, {', '.join(OPENING_FIELDS)}, "
+                f"height_mm, width_mm, wall_mm) "
+                f"VALUES (?, ?, {', '.join('?' for _ in OPENING_FIELDS)}, ?, ?, ?)",
+                [measurement_id, position] + [str(values[field]) for field in OPENING_FIELDS] + dims
+            )
+            opening_id = cur.lastrowid
+            conn.execute(
+                f"INSERT INTO openings_fts (rowid, {', '.join(FTS_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    opening_id,
+                    client_data.get("client_address", ""),
+                    str(values["room"]),
+                    str(values["door_type"]),
+                    str(values["dimensions"]),
+                    str(values["dobor"]),
+                    str(values["comment"]),
+                )
+            )
+            conn.executemany(
+                "INSERT INTO photos (opening_id, position, file_id, file_unique_id) VALUES (?, ?, ?, ?)",
+                [
+                    (opening_id, j, file_id, unique_id)
+                    for j, (file_id, unique_id) in enumerate(zip(values["photos"], values["photo_uids"]), start=1)
+                ]
+            )
+    return measurement_id
+
+def set_measurement_status(measurement_id: int, status: str):
+    conn = get_archive()
+    with conn:
+        conn.execute("UPDATE measurements SET status = ? WHERE id = ?", (status, measurement_id))
+
+def delete_measurement(measurement_id: int):
+    # Проёмы и фото удаляются каскадом, полнотекстовый индекс — вручную
+    conn = get_archive()
+    with conn:
+        conn.execute(
+            "DELETE FROM openings_fts WHERE rowid IN (SELECT id FROM openings WHERE measurement_id = ?)",
+            (measurement_id,)
+        )
+        conn.execute("DELETE FROM measurements WHERE id = ?", (measurement_id,))
+
+def parse_archive_date(text: str):
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d", "%d.%m.%y"):
+        try:
+            return datetime.strptime(text.strip(), fmt)
+        except ValueError:
+            continue
+    return None
+
+def archive_find(query: str, limit: int = ARCHIVE_FIND_LIMIT) -> list:
+    """Ищет замеры по дате, телефону или адресу. Возвращает строки measurements."""
+    conn = get_archive()
+    query = query.strip()
+    columns = ("SELECT m.*, (SELECT COUNT(*) FROM openings o WHERE o.measurement_id = m.id) AS openings_count "
+               "FROM measurements m ")
+    day = parse_archive_date(query)
+    if day:
+        start = day.strftime("%Y-%m-%d")
+        end = (day + timedelta(days=1)).strftime("%Y-%m-%d")
+        return conn.execute(
+            columns + "WHERE m.created_at >= ? AND m.created_at < ? ORDER BY m.created_at DESC LIMIT ?",
+            (start, end, limit)
+        ).fetchall()
+    digits = re.sub(r"\D", "", query)
+    if len(digits) >= 5 and not re.sub(r"[\d\s()+-]", "", query):
+        if len(digits) >= 10:
+            return conn.execute(
+                columns + "WHERE m.phone_digits = ? ORDER BY m.created_at DESC LIMIT ?",
+                (digits[-10:], limit)
+            ).fetchall()
+        return conn.execute(
+            columns + "WHERE m.phone_digits LIKE ? ORDER BY m.created_at DESC LIMIT ?",
+            (f"%{digits}%", limit)
+        ).fetchall()
+    address = normalize_address(query)
+    if not address:
+        return []
+    # Сначала префиксный поиск по индексу, затем — поиск по вхождению
+    rows = conn.execute(
+        columns + "WHERE m.address_norm >= ? AND m.address_norm < ? ORDER BY m.created_at DESC LIMIT ?",
+        (address, address + "\uffff", limit)
+    ).fetchall()
+    if rows:
+        return rows
+    pattern = "%" + address.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    return conn.execute(
+        columns + "WHERE m.address_norm LIKE ? ESCAPE '\\' ORDER BY m.created_at DESC LIMIT ?",
+        (pattern, limit)
+    ).fetchall()
+
+def archive_load(measurement_id: int):
+    """Восстанавливает client_data архивного замера в том же виде, что и при отправке."""
+    conn = get_archive()
+    row = conn.execute("SELECT * FROM measurements WHERE id = ?", (measurement_id,)).fetchone()
+    if row is None:
+        return None
+    client_data = {
+        "client_name": row["client_name"],
+        "client_phone": row["client_phone"],
+        "client_address": row["client_address"],
+        "status": row["status"],
+        "openings": []
+    }
+    opening_rows = conn.execute(
+        "SELECT * FROM openings WHERE measurement_id = ? ORDER BY position", (measurement_id,)
+    ).fetchall()
+    photo_rows = conn.execute(
+        "SELECT p.opening_id, p.file_id, p.file_unique_id FROM photos p JOIN openings o ON o.id = p.opening_id "
+        "WHERE o.measurement_id = ? ORDER BY p.opening_id, p.position", (measurement_id,)
+    ).fetchall()
+    photos_by_opening = {}
+    for photo in photo_rows:
+        photos_by_opening.setdefault(photo["opening_id"], []).append((photo["file_id"], photo["file_unique_id"]))
+    for op_row in opening_rows:
+        photos = photos_by_opening.get(op_row["id"], [])
+        client_data["openings"].append(Opening.from_dict(dict(
+            op_row,
+            photos=[file_id for file_id, _ in photos],
+            photo_uids=[unique_id for _, unique_id in photos]
+        )))
+    return client_data
+
+def build_search_query(text: str) -> str:
+    # Грубый стемминг: отбрасываем окончание, чтобы "скрытой" находило "Скрытая"
+    terms = []
+    for word in re.findall(r"\w+", text.lower().replace("ё", "е")):
+        if len(word) > 4 and not word.isdigit():
+            word = re.sub(r"[аеиоуыэюяйь]+$", "", word) or word
+        terms.append(f'"{word}"*')
+    return " ".join(terms)
+
+def archive_search(text: str, page: int = 0, page_size: int = SEARCH_PAGE_SIZE):
+    """Полнотекстовый поиск по проёмам. Возвращает (строки, есть_ли_следующая_страница)."""
+    match = build_search_query(text)
+    if not match:
+        return [], False
+    rows = get_archive().execute(
+        "SELECT o.*, m.created_at, m.client_name, m.client_address, m.status "
+        "FROM openings_fts f "
+        "JOIN openings o ON o.id = f.rowid "
+        "JOIN measurements m ON m.id = o.measurement_id "
+        "WHERE openings_fts MATCH ? ORDER BY f.rank, o.id DESC LIMIT ? OFFSET ?",
+        (match, page_size + 1, page * page_size)
+    ).fetchall()
+    return rows[:page_size], len(rows) > page_size
+
+def format_search_row(row) -> str:
+    created = datetime.strptime(row["created_at"], "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y")
+    details = [row["door_type"], row["dimensions"]]
+    if row["dobor"] and row["dobor"] not in ("---", "нет"):
+        details.append(f"добор {row['dobor']}")
+    status = ARCHIVE_STATUS_LABELS.get(row["status"], "")
+    text = (
+        f"#{row['measurement_id']} · {created}{status} · {row['client_address']}\n"
+        f"    Проём {row['position']} ({row['room']}): {', '.join(d for d in details if d)}"
+    )
+    if row["comment"]:
+        text += f"\n    Комментарий: {row['comment']}"
+    return text
+
+def format_archive_row(row) -> str:
+    created = datetime.strptime(row["created_at"], "%Y-%m-%d %H:%M:%S").strftime("%d.%m.%Y %H:%M")
+    draft = ARCHIVE_STATUS_LABELS.get(row["status"], "")
+    return (
+        f"#{row['id']} · {created}{draft} · {row['client_name']} · {row['client_phone']}\n"
+        f"    {row['client_address']} · проёмов: {row['openings_count']} · замерщик: {row['installer'] or '—'}"
+    )
+
+# -------------------------------------------------------------------
+# 4.2) ВЫГРУЗКА АРХИВА В CSV / XLSX
+# Строки читаются курсором и сразу пишутся в файл на диске, поэтому
+# память не растёт с размером выгрузки.
+# -------------------------------------------------------------------
+EXPORT_HEADERS = ["Замер", "Дата", "Замерщик", "Имя", "Телефон", "Адрес"] + TABLE_HEADERS
+
+def iter_export_rows(conn: sqlite3.Connection, date_from: datetime, date_to: datetime):
+    cursor = conn.execute(
+        f"SELECT m.id, m.created_at, m.installer, m.client_name, m.client_phone, m.client_address, "
+        f"o.position, {', '.join('o.' + field for field in OPENING_FIELDS)} "
+        "FROM measurements m JOIN openings o ON o.measurement_id = m.id "
+        "WHERE m.created_at >= ? AND m.created_at < ? AND m.status = 'sent' "
+        "ORDER BY m.created_at, m.id, o.position",
+        (date_from.strftime("%Y-%m-%d"), (date_to + timedelta(days=1)).strftime("%Y-%m-%d"))
+    )
+    for row in cursor:
+        yield list(row)
+
+def write_export_file(path: str, date_from: datetime, date_to: datetime, fmt: str) -> int:
+    """Пишет выгрузку в файл path. Возвращает количество строк."""
+    # Отдельное соединение: выгрузка идёт в потоке и не мешает основному
+    conn = sqlite3.connect(ARCHIVE_DB_PATH)
+    count = 0
+    try:
+        if fmt == "xlsx":
+            from openpyxl import Workbook
+            workbook = Workbook(write_only=True)
+            sheet = workbook.create_sheet("Замеры")
+            sheet.append(EXPORT_HEADERS)
+            try:
+                for row in iter_export_rows(conn, date_from, date_to):
+                    sheet.append(row)
+                    count += 1
+            finally:
+                # write-only книга копит строки во временном файле openpyxl,
+                # который удаляется только при сохранении
+                workbook.save(path)
         else:
-            media_group.append(InputMediaPhoto(processed_img))
-    await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+            # utf-8-sig и ";" — чтобы Excel с русской локалью открывал файл без мастера импорта
+            with open(path, "w", encoding="utf-8-sig", newline="") as tmp:
+                writer = csv.writer(tmp, delimiter=";")
+                writer.writerow(EXPORT_HEADERS)
+                for row in iter_export_rows(conn, date_from, date_to):
+                    writer.writerow(row)
+                    count += 1
+    finally:
+        conn.close()
+    return count
 
 # -------------------------------------------------------------------
 # 5) АВТОРИЗАЦИЯ. ЭТАП: "Запустить" → "Поделиться контактом"
@@ -262,27 +1369,67 @@ async def show_auth_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Добро пожаловать! Для использования бота нажмите «Запустить».", reply_markup=markup)
     return MENU  # Если пользователь нажмет "Запустить", перейдем в AUTH
 
+# -------------------------------------------------------------------
+# 6) /Отмена – кнопка "Отключить бот"
+# -------------------------------------------------------------------
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        drop_preview(update.effective_user.id)
+    await update.message.reply_text("Диалог отменён. Бот отключён. Для повторного запуска нажмите 'Запустить'.")
+    return ConversationHandler.END
+
+async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user:
+        drop_preview(update.effective_user.id)
+    await update.message.reply_text("Непредвиденная команда или сообщение. Диалог завершён.\nНажмите 'Запустить', чтобы начать заново.")
+    return ConversationHandler.END
+
+# -------------------------------------------------------------------
+# 7) ОСНОВНАЯ ФУНКЦИЯ АВТОРИЗАЦИИ – запуск и обработка контакта
+# -------------------------------------------------------------------
+async def start_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Entry point для авторизации – вместо /start показываем кнопку "Запустить"
+    keyboard = [
+        [KeyboardButton(LAUNCH_TEXT)],
+        [KeyboardButton(CANCEL_TEXT)]
+    ]
+    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    await update.message.reply_text("Нажмите 'Запустить' для авторизации.", reply_markup=markup)
+    return MENU
+
+async def menu_auth_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text
+    if text == LAUNCH_TEXT:
+        return await auth_request(update, context)
+    elif text == CANCEL_TEXT:
+        return await cancel(update, context)
+    else:
+        await update.message.reply_text("Нажмите 'Запустить' для авторизации или 'Отключить бот' для отмены.")
+        return MENU
+
+# -------------------------------------------------------------------
+# 8) ЭТАП АВТОРИЗАЦИИ: запрашиваем контакт
+# -------------------------------------------------------------------
 async def auth_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [KeyboardButton("Поделиться контактом", request_contact=True)],
         [KeyboardButton(CANCEL_TEXT)]
     ]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Для авторизации, пожалуйста, поделитесь своим контактом.", reply_markup=markup)
+    await update.message.reply_text("Для авторизации поделитесь, пожалуйста, своим контактом.", reply_markup=markup)
     return AUTH
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    contact: Contact = update.message.contact
+    contact = update.message.contact
     if not contact:
         await update.message.reply_text("Контакт не получен. Попробуйте ещё раз.")
         return AUTH
-
-    # Нормализуем номер: убираем все нецифровые символы
+    # Нормализуем номер (оставляем только цифры)
     phone = re.sub(r"\D", "", contact.phone_number)
     if phone in ALLOWED_NUMBERS:
         name = ALLOWED_NUMBERS[phone]
         context.user_data["authorized_name"] = name
-        greeting = f"Здравствуйте, {name}! Для начала замера нажмите кнопку 'Новый замер' или 'Отключить бот' для отмены."
+        greeting = f"Здравствуйте, {name}! Для начала замера нажмите 'Новый замер' или 'Отключить бот' для отмены."
         keyboard = [
             [KeyboardButton("Новый замер")],
             [KeyboardButton(CANCEL_TEXT)]
@@ -295,7 +1442,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
 # -------------------------------------------------------------------
-# 6) ОСНОВНАЯ ЛОГИКА ЗАМЕРА (как в предыдущем варианте)
+# 9) ОСНОВНАЯ ЛОГИКА ЗАМЕРА
 # -------------------------------------------------------------------
 async def menu_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
@@ -335,20 +1482,7 @@ async def get_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def start_opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == CANCEL_TEXT:
         return await cancel(update, context)
-    context.user_data["current_opening"] = {
-        "room": "",
-        "door_type": "",
-        "dimensions": "",
-        "canvas": "---",
-        "dobor": "---",
-        "dobor_count": "---",
-        "nalichniki": "---",
-        "threshold": "",
-        "demontage": "",
-        "opening": "---",
-        "comment": "",
-        "photos": []
-    }
+    context.user_data["current_opening"] = Opening()
     await update.message.reply_text("Введите название комнаты (например, 'Кухня'):", reply_markup=ReplyKeyboardRemove())
     return ENTER_ROOM
 
@@ -367,7 +1501,6 @@ async def enter_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ["Двустворчатая дверь (распашная)"],
         ["Иное"]
     ]
-    # Добавляем кнопку "Отключить бот" в конце клавиатуры, если нужно
     door_types.append([CANCEL_TEXT])
     markup = ReplyKeyboardMarkup(door_types, resize_keyboard=True)
     await update.message.reply_text("Выберите тип двери:", reply_markup=markup)
@@ -395,6 +1528,11 @@ async def enter_door_type_custom(update: Update, context: ContextTypes.DEFAULT_T
 async def enter_dimensions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == CANCEL_TEXT:
         return await cancel(update, context)
+    try:
+        parse_dimensions(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(str(e))
+        return ENTER_DIMENSIONS
     context.user_data["current_opening"]["dimensions"] = update.message.text
     door_type = context.user_data["current_opening"]["door_type"]
     if door_type == "Облагораживание проема":
@@ -426,9 +1564,8 @@ async def ask_dobor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     dobor_variants = [
         ["100 мм", "150 мм"],
         ["200 мм", "нет"],
-        ["Иное"],
+        ["Иное"]
     ]
-    # Добавляем кнопку "Отключить бот"
     dobor_variants.append([CANCEL_TEXT])
     markup = ReplyKeyboardMarkup(dobor_variants, resize_keyboard=True)
     await update.message.reply_text("Введите ширину добора:", reply_markup=markup)
@@ -498,11 +1635,10 @@ async def ask_nalichniki(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["current_opening"]["nalichniki"] = "---"
         return await ask_threshold(update, context)
     else:
-        # Добавляем кнопку "5,5" между "5" и "6"
         variants = [
             ["2,5"],
             ["5"],
-            ["5,5"],
+            ["5,5"],   # Добавленная кнопка "5,5"
             ["6"],
             ["нет"],
             ["Иное"]
@@ -578,7 +1714,8 @@ async def demontage_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ask_opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
     door_type = context.user_data["current_opening"]["door_type"]
-    if door_type in ["Облагораживание проема", "Складная дверь (книжка)", "Раздвижная дверь (одностворчатая)", "Раздвижная дверь (двустворчатая)", "Двустворчатая дверь (распашная)"]:
+    if door_type in ["Облагораживание проема", "Складная дверь (книжка)", "Раздвижная дверь (одностворчатая)",
+                     "Раздвижная дверь (двустворчатая)", "Двустворчатая дверь (распашная)"]:
         context.user_data["current_opening"]["opening"] = "---"
         return await ask_comment(update, context)
     else:
@@ -613,7 +1750,10 @@ async def opening_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return await ask_comment(update, context)
 
 async def ask_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [[KeyboardButton(SKIP_TEXT)], [CANCEL_TEXT]]
+    keyboard = [
+        [KeyboardButton(SKIP_TEXT)],
+        [CANCEL_TEXT]
+    ]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text("Введите комментарий или нажмите «Пропустить»:", reply_markup=markup)
     return ENTER_COMMENT
@@ -632,19 +1772,71 @@ async def enter_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [CANCEL_TEXT]
     ]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Прикрепите фото (по одной). Когда закончите, нажмите «Готово». Если нет фото – «Пропустить».", reply_markup=markup)
+    await update.message.reply_text("Прикрепите фото (по одному или альбомом). Когда закончите, нажмите «Готово». Если нет фото – «Пропустить».", reply_markup=markup)
     return ENTER_PHOTOS
 
+# Альбом из N фото приходит N сообщениями с одним media_group_id. Фото
+# сохраняются сразу, а подтверждение отправляется одно на весь альбом —
+# после паузы ALBUM_DEBOUNCE секунд без новых фото этого альбома.
+ALBUM_DEBOUNCE = float(os.environ.get("ALBUM_DEBOUNCE", "1.5"))
+pending_albums = {}   # (chat_id, media_group_id) -> {"count": int, "notes": list, "task": asyncio.Task}
+
+async def acknowledge_album_later(message, key):
+    await asyncio.sleep(ALBUM_DEBOUNCE)
+    album = pending_albums.pop(key, None)
+    if album:
+        notes = "".join(f"\n{note}" for note in album["notes"])
+        await message.reply_text(
+            f"Сохранено {album['count']} фото.{notes}\nМожете отправить ещё, или нажмите «Готово»."
+        )
+
+def cancel_album_acks(chat_id: int):
+    # Проём уже сохранён или диалог отменён — подтверждение альбома больше не нужно
+    for key in [key for key in pending_albums if key[0] == chat_id]:
+        pending_albums.pop(key)["task"].cancel()
+
+def register_photo(user_data: dict, file_id: str, unique_id: str):
+    """Добавляет фото к текущему проёму. Одно и то же фото (file_unique_id)
+    к проёму дважды не добавляется; если оно уже есть у другого проёма —
+    добавляется, но скачано и обработано будет один раз. Возвращает
+    (добавлено ли фото, заметка для замерщика или None)."""
+    current = user_data["current_opening"]
+    if unique_id in current.photo_uids:
+        return False, "Это фото уже добавлено к этому проёму — повтор пропущен."
+    current.photos.append(file_id)
+    current.photo_uids.append(unique_id)
+    for number, op in enumerate(user_data.get("openings", []), start=1):
+        if unique_id in op.photo_uids:
+            return True, f"Это фото уже прикреплено к проёму #{number} ({op.room}) — оно будет добавлено и сюда."
+    return True, None
+
 async def enter_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
+    if update.message.text == CANCEL_TEXT:
+        cancel_album_acks(update.effective_chat.id)
         return await cancel(update, context)
-    if text == SKIP_TEXT or text == DONE_TEXT:
+    if update.message.text in [SKIP_TEXT, DONE_TEXT]:
+        cancel_album_acks(update.effective_chat.id)
         return await save_opening(update, context)
     if update.message.photo:
-        file_id = update.message.photo[-1].file_id
-        context.user_data["current_opening"]["photos"].append(file_id)
-        await update.message.reply_text("Фото сохранено. Можете отправить ещё, или нажмите «Готово».")
+        photo = update.message.photo[-1]
+        saved, note = register_photo(context.user_data, photo.file_id, photo.file_unique_id)
+        media_group_id = update.message.media_group_id
+        if not media_group_id:
+            if saved:
+                text = "Фото сохранено. Можете отправить ещё, или нажмите «Готово»."
+                await update.message.reply_text(f"{note}\n{text}" if note else text)
+            else:
+                await update.message.reply_text(note)
+            return ENTER_PHOTOS
+        key = (update.effective_chat.id, media_group_id)
+        album = pending_albums.setdefault(key, {"count": 0, "notes": [], "task": None})
+        if saved:
+            album["count"] += 1
+        if note:
+            album["notes"].append(note)
+        if album["task"]:
+            album["task"].cancel()
+        album["task"] = context.application.create_task(acknowledge_album_later(update.message, key))
         return ENTER_PHOTOS
     else:
         await update.message.reply_text("Отправьте фото, либо нажмите «Готово» или «Пропустить».")
@@ -655,6 +1847,7 @@ async def save_opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await cancel(update, context)
     current = context.user_data["current_opening"]
     context.user_data["openings"].append(current)
+    schedule_preview(context, update.effective_user.id)
     keyboard = [
         [KeyboardButton("Следующий проём")],
         [KeyboardButton("Редактировать проём"), KeyboardButton("Удалить проём")],
@@ -683,25 +1876,100 @@ async def handle_opening_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # -------------------------------------------------------------------
 # ЭТАП ПРОВЕРКИ: "Проверить и завершить"
+# Таблица для проверки рисуется заранее, в фоне: после сохранения, правки и
+# удаления проёма. Каждый новый запуск отменяет предыдущий, а отпечаток
+# данных гарантирует, что в check_measure не уйдёт устаревшая картинка.
+# Рендер даёт пару: лёгкое превью для замерщика и полное PNG, которое при
+# завершении без правок уходит в рабочий чат без повторной отрисовки.
 # -------------------------------------------------------------------
+preview_renders = {}   # user_id -> (отпечаток данных, asyncio.Task с парой (PNG, превью))
+
+def measurement_client_data(user_data) -> dict:
+    return {
+        "client_name": user_data.get("client_name", ""),
+        "client_phone": user_data.get("client_phone", ""),
+        "client_address": user_data.get("client_address", ""),
+        "openings": list(user_data.get("openings", []))
+    }
+
+def measurement_fingerprint(client_data: dict) -> tuple:
+    openings = tuple(
+        tuple(getattr(op, field) for field in OPENING_FIELDS) + (op.photo,) for op in client_data["openings"]
+    )
+    return (client_data["client_name"], client_data["client_phone"], client_data["client_address"], openings)
+
+def drop_preview(user_id: int):
+    entry = preview_renders.pop(user_id, None)
+    if entry:
+        entry[1].cancel()
+
+def schedule_preview(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    # Отмена задачи убирает рендер из очереди пула; уже начатый дорисуется и будет отброшен
+    drop_preview(user_id)
+    client_data = measurement_client_data(context.user_data)
+    if client_data["openings"]:
+        task = context.application.create_task(run_in_render_pool(generate_measurement_images, client_data))
+        preview_renders[user_id] = (measurement_fingerprint(client_data), task)
+
+def copy_image(image: io.BytesIO) -> io.BytesIO:
+    copy = io.BytesIO(image.getvalue())
+    copy.name = image.name
+    return copy
+
+async def render_preview(user_id: int, client_data: dict) -> tuple:
+    """(полное PNG, превью) для текущих данных: из фонового рендера или заново."""
+    entry = preview_renders.get(user_id)
+    if entry and entry[0] == measurement_fingerprint(client_data):
+        try:
+            images = await entry[1]
+            # Картинки остаются в запасе для повторной проверки и завершения
+            return tuple(copy_image(image) for image in images)
+        except asyncio.CancelledError:
+            if not entry[1].cancelled():
+                raise
+        except Exception as e:
+            logging.error("Фоновый рендер таблицы не удался: %s", e)
+    drop_preview(user_id)
+    images = await run_in_render_pool(generate_measurement_images, client_data)
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(images)
+    preview_renders[user_id] = (measurement_fingerprint(client_data), future)
+    return tuple(copy_image(image) for image in images)
+
+def archive_pending(user_data, client_data: dict, installer_id: int = None):
+    """Записывает замер в архив со статусом 'pending' до отправки: номер нужен
+    в подписи (/photos). Если отправка сорвалась, повторное «Завершить замер»
+    с теми же данными переиспользует запись, а после правки — заменяет её."""
+    fingerprint = (measurement_fingerprint(client_data),
+                   tuple(tuple(op.photos) for op in client_data["openings"]))
+    pending = user_data.get("pending_measurement")
+    if pending and pending[1] == fingerprint:
+        return pending[0]
+    try:
+        if pending:
+            delete_measurement(pending[0])
+        measurement_id = archive_measurement(
+            client_data,
+            installer=user_data.get("authorized_name", ""),
+            installer_id=installer_id,
+            status="pending"
+        )
+        logging.info("Замер #%s сохранён в архив", measurement_id)
+    except Exception as e:
+        logging.error("Ошибка сохранения замера в архив: %s", e)
+        user_data.pop("pending_measurement", None)
+        return None
+    user_data["pending_measurement"] = (measurement_id, fingerprint)
+    return measurement_id
+
 async def check_measure(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == CANCEL_TEXT:
         return await cancel(update, context)
-    name = context.user_data.get("client_name", "")
-    phone = context.user_data.get("client_phone", "")
-    address = context.user_data.get("client_address", "")
-    openings = context.user_data.get("openings", [])
-    client_data = {
-        "client_name": name,
-        "client_phone": phone,
-        "client_address": address,
-        "openings": []
-    }
-    for op in openings:
-        copy_op = dict(op)
-        copy_op["photo"] = "есть" if copy_op["photos"] else "нет"
-        client_data["openings"].append(copy_op)
-    image_data = generate_measurement_image(client_data)
+    client_data = measurement_client_data(context.user_data)
+    name = client_data["client_name"]
+    phone = client_data["client_phone"]
+    address = client_data["client_address"]
+    _, image_data = await render_preview(update.effective_user.id, client_data)
     caption_text = f"Имя: {name}\nТелефон: {phone}\nАдрес: {address}"
     await update.message.reply_photo(photo=image_data, caption=caption_text)
     keyboard = [
@@ -710,7 +1978,7 @@ async def check_measure(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [CANCEL_TEXT]
     ]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Проверьте замер. Если всё правильно – нажмите «Завершить замер», иначе – «Редактировать замер».", reply_markup=markup)
+    await update.message.reply_text("Проверьте замер. Если всё правильно – нажмите 'Завершить замер', иначе – 'Редактировать замер'.", reply_markup=markup)
     return CHECK_MEASURE
 
 async def check_measure_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -720,36 +1988,27 @@ async def check_measure_response(update: Update, context: ContextTypes.DEFAULT_T
     elif text == "Завершить замер":
         return await confirm_finish(update, context)
     else:
-        await update.message.reply_text("Пожалуйста, выберите «Редактировать замер» или «Завершить замер».")
+        await update.message.reply_text("Пожалуйста, выберите 'Редактировать замер' или 'Завершить замер'.")
         return CHECK_MEASURE
 
 async def confirm_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == CANCEL_TEXT:
         return await cancel(update, context)
-    name = context.user_data.get("client_name", "")
-    phone = context.user_data.get("client_phone", "")
-    address = context.user_data.get("client_address", "")
-    openings = context.user_data.get("openings", [])
-    client_data = {
-        "client_name": name,
-        "client_phone": phone,
-        "client_address": address,
-        "openings": []
-    }
-    for op in openings:
-        copy_op = dict(op)
-        copy_op["photo"] = "есть" if copy_op["photos"] else "нет"
-        client_data["openings"].append(copy_op)
-    image_data = generate_measurement_image(client_data)
-    caption_text = f"Имя: {name}\nТелефон: {phone}\nАдрес: {address}"
-    await context.bot.send_photo(chat_id=TARGET_CHAT_ID, photo=image_data, caption=caption_text)
-    photo_overlays = []
-    for i, op in enumerate(openings, start=1):
-        for j, file_id in enumerate(op["photos"], start=1):
-            overlay_text = f"Фото {j} проёма #{i} ({op['room']})"
-            photo_overlays.append((file_id, overlay_text))
-    if photo_overlays:
-        await send_photos_with_overlay_as_album(context, TARGET_CHAT_ID, photo_overlays)
+    client_data = measurement_client_data(context.user_data)
+    measurement_id = archive_pending(context.user_data, client_data,
+                                     update.effective_user.id if update.effective_user else None)
+    table_image, _ = await render_preview(update.effective_user.id, client_data)
+    await send_measurement(context, TARGET_CHAT_ID, client_data, measurement_id, table_image)
+    if measurement_id is not None:
+        try:
+            set_measurement_status(measurement_id, "sent")
+        except Exception as e:
+            logging.error("Ошибка обновления статуса замера #%s: %s", measurement_id, e)
+    # Замер отправлен — черновик в памяти больше не нужен
+    drop_preview(update.effective_user.id)
+    for key in ("client_name", "client_phone", "client_address", "openings", "current_opening",
+                "pending_measurement"):
+        context.user_data.pop(key, None)
     keyboard = [[KeyboardButton("Новый замер")]]
     markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     await update.message.reply_text("Замер успешно отправлен в рабочий чат. Вы можете начать новый замер.", reply_markup=markup)
@@ -825,8 +2084,15 @@ async def edit_value_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     new_value = update.message.text
     index = context.user_data["edit_index"]
     field = context.user_data["edit_field"]
+    if field == "dimensions":
+        try:
+            parse_dimensions(new_value)
+        except ValueError as e:
+            await update.message.reply_text(str(e))
+            return EDIT_VALUE
     openings = context.user_data["openings"]
     openings[index][field] = new_value
+    schedule_preview(context, update.effective_user.id)
     await update.message.reply_text(f"Поле «{field}» обновлено на: {new_value}.")
     fields = [
         "Комната", "Тип двери", "Размеры", "Полотно",
@@ -835,7 +2101,7 @@ async def edit_value_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     ]
     kb = [[KeyboardButton(f)] for f in fields] + [[KeyboardButton("Готово")]]
     markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите поле для изменения ещё или нажмите «Готово»:", reply_markup=markup)
+    await update.message.reply_text("Выберите поле для изменения ещё или нажмите 'Готово':", reply_markup=markup)
     return EDIT_FIELD
 
 async def opening_menu_return(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -888,940 +2154,1111 @@ async def delete_confirm_handler(update: Update, context: ContextTypes.DEFAULT_T
     if text == "да, удалить":
         index = context.user_data["delete_index"]
         proem = context.user_data["openings"].pop(index)
+        schedule_preview(context, update.effective_user.id)
         await update.message.reply_text(f"Проём «{proem['room']}» удалён.")
     else:
         await update.message.reply_text("Удаление отменено.")
     return await opening_menu_return(update, context)
 
 # -------------------------------------------------------------------
-# 7) /Отмена и fallback
+# АРХИВ: ПОИСК, ВЫГРУЗКА И ПОВТОРНАЯ ОТПРАВКА (/find, /search, /export, /resend, /photos)
+# Команды работают в любом состоянии диалога и не сбрасывают его.
 # -------------------------------------------------------------------
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Диалог отменён. Бот отключён. Для повторного запуска нажмите 'Запустить'.")
-    return ConversationHandler.END
+async def require_authorized(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    if context.user_data.get("authorized_name"):
+        return True
+    await update.effective_message.reply_text("Доступ закрыт. Сначала авторизуйтесь: нажмите «Запустить».")
+    return False
+
+async def archive_find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_authorized(update, context):
+        raise ApplicationHandlerStop
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /find <телефон | адрес | дата ДД.ММ.ГГГГ>")
+        raise ApplicationHandlerStop
+    rows = archive_find(query)
+    if not rows:
+        await update.message.reply_text("Ничего не найдено.")
+    else:
+        lines = [format_archive_row(row) for row in rows]
+        lines.append("\nДля повторной отправки: /resend <номер>")
+        await update.message.reply_text("\n".join(lines))
+    raise ApplicationHandlerStop
+
+def render_search_page(query: str, query_id: int, page: int):
+    rows, has_next = archive_search(query, page)
+    if not rows:
+        return ("Ничего не найдено." if page == 0 else "Больше результатов нет."), None
+    lines = [f"Поиск: «{query}», страница {page + 1}"]
+    lines += [format_search_row(row) for row in rows]
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀ Назад", callback_data=f"search:{query_id}:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперёд ▶", callback_data=f"search:{query_id}:{page + 1}"))
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join(lines), markup
+
+async def archive_search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_authorized(update, context):
+        raise ApplicationHandlerStop
+    query = " ".join(context.args)
+    if not query:
+        await update.message.reply_text("Использование: /search <слова>, например: /search скрытая 200 Ленина")
+        raise ApplicationHandlerStop
+    # Кнопки листания несут номер запроса: после нового /search старые
+    # результаты продолжают листать свой запрос
+    queries = context.user_data.setdefault("search_queries", {})
+    query_id = context.user_data.get("search_query_id", 0) + 1
+    context.user_data["search_query_id"] = query_id
+    queries[query_id] = query
+    for old_id in sorted(queries)[:-SEARCH_QUERIES_KEPT]:
+        del queries[old_id]
+    text, markup = render_search_page(query, query_id, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+    raise ApplicationHandlerStop
+
+async def archive_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    callback = update.callback_query
+    await callback.answer()
+    if not context.user_data.get("authorized_name"):
+        raise ApplicationHandlerStop
+    _, query_id, page = callback.data.split(":")
+    query_id, page = int(query_id), int(page)
+    query = context.user_data.get("search_queries", {}).get(query_id)
+    if not query:
+        await callback.edit_message_text("Результаты устарели, повторите /search.")
+        raise ApplicationHandlerStop
+    text, markup = render_search_page(query, query_id, page)
+    await callback.edit_message_text(text, reply_markup=markup)
+    raise ApplicationHandlerStop
+
+async def archive_export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_authorized(update, context):
+        raise ApplicationHandlerStop
+    args = list(context.args)
+    fmt = "csv"
+    if args and args[-1].lower() in ("csv", "xlsx"):
+        fmt = args.pop().lower()
+    dates = [parse_archive_date(arg) for arg in args]
+    if not dates or len(dates) > 2 or None in dates:
+        await update.message.reply_text(
+            "Использование: /export <с ДД.ММ.ГГГГ> [по ДД.ММ.ГГГГ] [csv|xlsx]\n"
+            "Например: /export 01.03.2025 31.03.2025 xlsx"
+        )
+        raise ApplicationHandlerStop
+    date_from, date_to = dates[0], dates[-1]
+    if date_to < date_from:
+        date_from, date_to = date_to, date_from
+    get_archive()  # схема должна существовать до чтения из отдельного соединения
+    # Временный файл создаётся здесь, чтобы удалить его и при ошибке записи
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(write_export_file, path, date_from, date_to, fmt)
+        if count == 0:
+            await update.message.reply_text("За указанный период замеров нет.")
+            raise ApplicationHandlerStop
+        filename = f"zamery_{date_from:%Y-%m-%d}_{date_to:%Y-%m-%d}.{fmt}"
+        with open(path, "rb") as document:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=document,
+                filename=filename,
+                caption=f"Проёмов в выгрузке: {count}"
+            )
+    finally:
+        os.remove(path)
+    raise ApplicationHandlerStop
+
+async def archive_resend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_authorized(update, context):
+        raise ApplicationHandlerStop
+    try:
+        measurement_id = int(context.args[0].lstrip("#"))
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /resend <номер замера>")
+        raise ApplicationHandlerStop
+    client_data = archive_load(measurement_id)
+    if client_data is None:
+        await update.message.reply_text(f"Замер #{measurement_id} не найден в архиве.")
+        raise ApplicationHandlerStop
+    if client_data["status"] == "draft":
+        # Черновик закрыт по таймауту недозаполненным — в рабочий чат как готовый замер не уходит
+        await update.message.reply_text(f"Замер #{measurement_id} — незавершённый черновик, отправить его нельзя.")
+        raise ApplicationHandlerStop
+    await send_measurement(context, TARGET_CHAT_ID, client_data, measurement_id)
+    if client_data["status"] == "pending":
+        set_measurement_status(measurement_id, "sent")
+    await update.message.reply_text(f"Замер #{measurement_id} повторно отправлен в рабочий чат.")
+    raise ApplicationHandlerStop
+
+async def archive_photos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Фото замера в полном размере альбомом в тот чат, откуда пришла команда.
+    # В рабочем чате доступна всем: там в режиме sheet видны только листы.
+    in_target_chat = update.effective_chat is not None and update.effective_chat.id == TARGET_CHAT_ID
+    if not in_target_chat and not await require_authorized(update, context):
+        raise ApplicationHandlerStop
+    try:
+        measurement_id = int(context.args[0].lstrip("#"))
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /photos <номер замера>")
+        raise ApplicationHandlerStop
+    client_data = archive_load(measurement_id)
+    if client_data is None:
+        await update.message.reply_text(f"Замер #{measurement_id} не найден в архиве.")
+        raise ApplicationHandlerStop
+    photo_overlays = measurement_photo_overlays(client_data)
+    if not photo_overlays:
+        await update.message.reply_text(f"В замере #{measurement_id} нет фото.")
+        raise ApplicationHandlerStop
+    await send_photos_with_overlay_as_album(context, update.effective_chat.id, photo_overlays)
+    raise ApplicationHandlerStop
 
-async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Непредвиденная команда или сообщение. Диалог завершён.\nНажмите 'Запустить', чтобы начать заново.")
-    return ConversationHandler.END
+# -------------------------------------------------------------------
+# ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ
+# Апдейты разных чатов обрабатываются одновременно (не более
+# CONCURRENT_UPDATES сразу), апдейты одного чата — строго по очереди,
+# чтобы ConversationHandler видел состояние диалога в правильном порядке.
+# -------------------------------------------------------------------
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "16"))
+
+def serialization_key(update: object):
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+class SerializedApplication(Application):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # key -> [asyncio.Lock, число ожидающих]; запись удаляется, когда чат простаивает
+        self._chat_locks = {}
+        self._processing = asyncio.Semaphore(max(CONCURRENT_UPDATES, 1))
+
+    @contextlib.asynccontextmanager
+    async def chat_lock(self, key):
+        """Очередь чата: апдейты одного чата и фоновые действия над ним идут по одному."""
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[key]
+
+    async def process_update(self, update: object) -> None:
+        health_state["last_update"] = time.monotonic()
+        touch_session(update)
+        key = serialization_key(update)
+        if key is None:
+            async with self._processing:
+                await super().process_update(update)
+            return
+        # Слот общего лимита берём только после своей очереди в чате,
+        # иначе ожидающие апдейты одного чата заняли бы все слоты
+        async with self.chat_lock(key):
+            async with self._processing:
+                await super().process_update(update)
 
 # -------------------------------------------------------------------
-# 8) ГЛОБАЛЬНАЯ АВТОРИЗАЦИЯ: ЭТАП АВТОРИЗАЦИИ
+# HTTP-ПУЛЫ: МЕДИА, ИНТЕРАКТИВНЫЕ ОТВЕТЫ, ПОЛУЧЕНИЕ АПДЕЙТОВ
+# Загрузка альбома не должна занимать соединения, через которые уходят
+# короткие reply_text и getUpdates. Каждый пул настраивается отдельно:
+# HTTP_<ПУЛ>_POOL_SIZE, _CONNECT_TIMEOUT, _READ_TIMEOUT, _WRITE_TIMEOUT,
+# _POOL_TIMEOUT, _HTTP2, где <ПУЛ> — INTERACTIVE, MEDIA или UPDATES.
 # -------------------------------------------------------------------
-async def auth_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [KeyboardButton("Поделиться контактом", request_contact=True)],
-        [KeyboardButton(CANCEL_TEXT)]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Для авторизации, пожалуйста, поделитесь своим контактом.", reply_markup=markup)
-    return AUTH
+HTTP_POOL_DEFAULTS = {
+    "INTERACTIVE": {"pool_size": 8, "connect": 10.0, "read": 15.0, "write": 15.0, "pool": 5.0},
+    "MEDIA": {"pool_size": 4, "connect": 30.0, "read": 60.0, "write": 120.0, "pool": 60.0},
+    "UPDATES": {"pool_size": 1, "connect": 10.0, "read": 60.0, "write": 10.0, "pool": 5.0},
+}
+
+# Методы, которые передают файлы, и получение ссылки на файл перед скачиванием
+MEDIA_ENDPOINTS = {
+    "sendPhoto", "sendMediaGroup", "sendDocument", "sendVideo",
+    "sendAnimation", "sendAudio", "sendVoice", "getFile"
+}
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+def http_pool_timeout(pool: str, kind: str) -> float:
+    # kind — connect, read, write или pool
+    return float(os.environ.get(f"HTTP_{pool}_{kind.upper()}_TIMEOUT", HTTP_POOL_DEFAULTS[pool][kind]))
+
+def build_http_request(pool: str) -> HTTPXRequest:
+    prefix = f"HTTP_{pool}_"
+    kwargs = dict(
+        connection_pool_size=int(os.environ.get(prefix + "POOL_SIZE", HTTP_POOL_DEFAULTS[pool]["pool_size"])),
+        connect_timeout=http_pool_timeout(pool, "connect"),
+        read_timeout=http_pool_timeout(pool, "read"),
+        write_timeout=http_pool_timeout(pool, "write"),
+        pool_timeout=http_pool_timeout(pool, "pool"),
+    )
+    if env_bool(prefix + "HTTP2"):
+        try:
+            return HTTPXRequest(http_version="2", **kwargs)
+        except RuntimeError as e:
+            # HTTP/2 требует python-telegram-bot[http2]; без него работаем по HTTP/1.1
+            logging.warning("Пул %s: HTTP/2 недоступен (%s), используется HTTP/1.1", pool, e)
+    return HTTPXRequest(**kwargs)
+
+class RoutingRequest(BaseRequest):
+    """Отправляет медиа-запросы и скачивание файлов в отдельный пул соединений.
+    PTB передаёт в send_photo/send_media_group явный write_timeout=20, поэтому
+    для медиа-пула он заменяется на media_write_timeout (HTTP_MEDIA_WRITE_TIMEOUT)."""
+
+    def __init__(self, interactive: BaseRequest, media: BaseRequest, media_write_timeout: float = None):
+        self.interactive = interactive
+        self.media = media
+        self.media_write_timeout = media_write_timeout
+
+    async def initialize(self) -> None:
+        await asyncio.gather(self.interactive.initialize(), self.media.initialize())
+
+    async def shutdown(self) -> None:
+        await asyncio.gather(self.interactive.shutdown(), self.media.shutdown())
+
+    def pick(self, url: str) -> BaseRequest:
+        if is_file_download(url):
+            return self.media
+        endpoint = url.rsplit("/", 1)[-1]
+        return self.media if endpoint in MEDIA_ENDPOINTS else self.interactive
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        target = self.pick(url)
+        if target is self.media and self.media_write_timeout is not None:
+            write_timeout = self.media_write_timeout
+        health_state["outbox_pending"] += 1
+        try:
+            return await target.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        finally:
+            health_state["outbox_pending"] -= 1
+
+class PollTrackingRequest(BaseRequest):
+    """Запрос для getUpdates, отмечающий время каждого успешного опроса."""
+
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        result = await self.request.do_request(
+            url, method, request_data=request_data, read_timeout=read_timeout,
+            write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+        )
+        health_state["last_poll"] = time.monotonic()
+        return result
 
-async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    contact = update.message.contact
-    if not contact:
-        await update.message.reply_text("Контакт не получен. Попробуйте ещё раз.")
-        return AUTH
-    phone = re.sub(r"\D", "", contact.phone_number)
-    if phone in ALLOWED_NUMBERS:
-        name = ALLOWED_NUMBERS[phone]
-        context.user_data["authorized_name"] = name
-        greeting = f"Здравствуйте, {name}! Для начала замера нажмите кнопку 'Новый замер' или 'Отключить бот' для отмены."
-        keyboard = [
-            [KeyboardButton("Новый замер")],
-            [KeyboardButton(CANCEL_TEXT)]
-        ]
-        markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text(greeting, reply_markup=markup)
-        return MENU
-    else:
-        await update.message.reply_text("Извините, ваш номер не найден в базе. Доступ закрыт.")
-        return ConversationHandler.END
+# -------------------------------------------------------------------
+# ЛОКАЛЬНЫЙ СЕРВЕР BOT API
+# BOT_API_URL=http://telegram-bot-api:8081/bot — запросы идут в собственный
+# telegram-bot-api вместо api.telegram.org: скачивание без лимита 20 МБ и без
+# дороги до удалённого сервера. В режиме --local (BOT_API_LOCAL_MODE, включён
+# по умолчанию вместе с BOT_API_URL) getFile возвращает абсолютный путь на
+# диске сервера; если этот каталог смонтирован и в контейнер бота
+# (BOT_API_SERVER_DIR → BOT_API_FILES_DIR), файл читается прямо с диска,
+# иначе скачивается по BOT_API_FILE_URL (например, через nginx).
+# -------------------------------------------------------------------
+BOT_API_URL = os.environ.get("BOT_API_URL", "").rstrip("/")
+BOT_API_FILE_URL = os.environ.get("BOT_API_FILE_URL", "").rstrip("/")
+if BOT_API_URL and not BOT_API_FILE_URL and BOT_API_URL.endswith("/bot"):
+    BOT_API_FILE_URL = BOT_API_URL[:-len("bot")] + "file/bot"
+BOT_API_LOCAL_MODE = env_bool("BOT_API_LOCAL_MODE", bool(BOT_API_URL))
+BOT_API_SERVER_DIR = os.environ.get("BOT_API_SERVER_DIR", "/var/lib/telegram-bot-api").rstrip("/")
+BOT_API_FILES_DIR = os.environ.get("BOT_API_FILES_DIR", BOT_API_SERVER_DIR).rstrip("/")
+
+def is_file_download(url: str) -> bool:
+    return "/file/bot" in url or bool(BOT_API_FILE_URL and url.startswith(BOT_API_FILE_URL))
+
+def local_file_path(bot, file_path: str):
+    """Путь к файлу на нашем диске или None, если файл надо скачивать по HTTP."""
+    if not BOT_API_LOCAL_MODE or not file_path:
+        return None
+    # Если путь сервера у нас не существует, PTB приклеивает к нему base_file_url
+    prefix = f"{bot.base_file_url}/"
+    if file_path.startswith(prefix):
+        file_path = file_path[len(prefix):]
+    if not os.path.isabs(file_path):
+        return None
+    if file_path == BOT_API_SERVER_DIR or file_path.startswith(BOT_API_SERVER_DIR + "/"):
+        file_path = BOT_API_FILES_DIR + file_path[len(BOT_API_SERVER_DIR):]
+    return file_path if os.path.isfile(file_path) else None
+
+def read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
 
 # -------------------------------------------------------------------
-# 9) ЭТАП ПРОВЕРКИ: "Проверить и завершить"
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ ИСХОДЯЩИХ ЗАПРОСОВ (flood control)
+# Корзины токенов: общая на бота и отдельная на каждый чат (группы —
+# RATE_GROUP_PER_MIN в минуту, личные чаты — RATE_PRIVATE_PER_SEC в секунду).
+# Интерактивные ответы обслуживаются раньше массовой отправки медиа.
+# При RetryAfter запрос повторяется после указанной паузы, а корзина чата
+# «уходит в минус», чтобы остальные запросы в этот чат тоже подождали.
 # -------------------------------------------------------------------
-async def check_measure(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    name = context.user_data.get("client_name", "")
-    phone = context.user_data.get("client_phone", "")
-    address = context.user_data.get("client_address", "")
-    openings = context.user_data.get("openings", [])
-    client_data = {
-        "client_name": name,
-        "client_phone": phone,
-        "client_address": address,
-        "openings": []
+RATE_GLOBAL_PER_SEC = float(os.environ.get("RATE_GLOBAL_PER_SEC", "30"))
+RATE_GROUP_PER_MIN = float(os.environ.get("RATE_GROUP_PER_MIN", "20"))
+RATE_PRIVATE_PER_SEC = float(os.environ.get("RATE_PRIVATE_PER_SEC", "1"))
+RATE_MAX_RETRIES = int(os.environ.get("RATE_MAX_RETRIES", "3"))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+BULK_ENDPOINTS = {"sendPhoto", "sendMediaGroup", "sendDocument", "sendVideo", "sendAnimation", "sendAudio"}
+
+class TokenBucket:
+    """Корзина токенов с очередью ожидающих по приоритету (меньше — раньше)."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.waiters = []       # куча (приоритет, порядковый номер, стоимость, future)
+        self.sequence = 0
+        self.timer = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def penalize(self, seconds: float):
+        # Следующий токен появится ровно через seconds
+        self.refill()
+        self.tokens = min(self.tokens, min(1, self.capacity) - seconds * self.rate)
+
+    async def acquire(self, cost: float = 1, priority: int = PRIORITY_INTERACTIVE):
+        self.refill()
+        # Дорогой запрос (альбом) ждёт полную корзину, а не больше её ёмкости
+        need = min(cost, self.capacity)
+        if not self.waiters and self.tokens >= need:
+            self.tokens -= cost
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        heapq.heappush(self.waiters, (priority, self.sequence, cost, future))
+        self.wake()
+        await future
+
+    def wake(self):
+        self.timer = None
+        self.refill()
+        while self.waiters:
+            _, _, cost, future = self.waiters[0]
+            if future.done():   # ожидание отменено
+                heapq.heappop(self.waiters)
+                continue
+            if self.tokens < min(cost, self.capacity):
+                break
+            heapq.heappop(self.waiters)
+            self.tokens -= cost
+            future.set_result(None)
+        if self.waiters and self.timer is None:
+            _, _, cost, _ = self.waiters[0]
+            delay = max(0.01, (min(cost, self.capacity) - self.tokens) / self.rate)
+            self.timer = asyncio.get_running_loop().call_later(delay, self.wake)
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self):
+        self.overall = TokenBucket(RATE_GLOBAL_PER_SEC, RATE_GLOBAL_PER_SEC)
+        self.chats = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(RATE_GROUP_PER_MIN / 60, RATE_GROUP_PER_MIN)
+            else:
+                bucket = TokenBucket(RATE_PRIVATE_PER_SEC, max(RATE_PRIVATE_PER_SEC, 3))
+            self.chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        priority = PRIORITY_BULK if endpoint in BULK_ENDPOINTS else PRIORITY_INTERACTIVE
+        # Каждое фото альбома Telegram считает отдельным сообщением
+        cost = len(data.get("media") or ()) or 1
+        for attempt in range(RATE_MAX_RETRIES + 1):
+            health_state["outbox_waiting"] += 1
+            try:
+                if chat_id is not None:
+                    await self.chat_bucket(chat_id).acquire(cost, priority)
+                await self.overall.acquire(cost, priority)
+            finally:
+                health_state["outbox_waiting"] -= 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == RATE_MAX_RETRIES:
+                    logging.error("Flood control: %s в чат %s не отправлен после %s попыток",
+                                  endpoint, chat_id, RATE_MAX_RETRIES + 1)
+                    raise
+                pause = float(e.retry_after) + 0.1
+                logging.warning("Flood control: %s в чат %s, повтор через %.1f с", endpoint, chat_id, pause)
+                if chat_id is not None:
+                    self.chat_bucket(chat_id).penalize(pause)
+                else:
+                    self.overall.penalize(pause)
+
+# -------------------------------------------------------------------
+# HEALTH / READINESS
+# Небольшой HTTP-сервер (HEALTH_PORT, по умолчанию PORT от Railway):
+#   /health — процесс и цикл событий живы (всегда 200, если отвечает);
+#   /ready  — бот реально получает апдейты и цикл не завис (200 или 503).
+# -------------------------------------------------------------------
+HEALTH_PORT = int(os.environ.get("HEALTH_PORT") or os.environ.get("PORT") or 0)
+READY_MAX_POLL_AGE = float(os.environ.get("READY_MAX_POLL_AGE", "90"))
+READY_MAX_LOOP_LAG = float(os.environ.get("READY_MAX_LOOP_LAG", "5"))
+READY_MAX_RENDER_AGE = float(os.environ.get("READY_MAX_RENDER_AGE", "120"))
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_WINDOW = 120   # замеров в окне: 120 × 0,5 с = последняя минута
+# Если цикл не отвечает дольше LOOP_BLOCK_THRESHOLD секунд, сторожевой поток
+# пишет в лог стек потока цикла — то есть тот вызов, который его блокирует
+LOOP_BLOCK_THRESHOLD = float(os.environ.get("LOOP_BLOCK_THRESHOLD", "0.3"))
+
+health_state = {
+    "started": time.monotonic(),
+    "last_update": None,    # последний апдейт, попавший в обработку
+    "last_poll": None,      # последний успешный getUpdates
+    "outbox_pending": 0,    # исходящие запросы к Bot API в работе
+    "outbox_waiting": 0,    # запросы, ожидающие своей очереди в ограничителе частоты
+    "loop_heartbeat": None, # последний раз, когда цикл событий дошёл до монитора задержки
+    "loop_blocks": 0,       # сколько раз сторож ловил блокировку цикла
+}
+loop_lag_samples = deque(maxlen=LOOP_LAG_WINDOW)
+render_jobs = {}            # задачи рендера (в пуле и в очереди к нему) -> время постановки
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    health_state["loop_heartbeat"] = time.monotonic()
+    while True:
+        expected = loop.time() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_samples.append(max(0.0, loop.time() - expected))
+        health_state["loop_heartbeat"] = time.monotonic()
+
+def watch_loop_blocks(loop_thread_id: int):
+    import sys
+    import traceback
+    reported = None
+    while True:
+        time.sleep(LOOP_BLOCK_THRESHOLD / 2)
+        heartbeat = health_state["loop_heartbeat"]
+        if heartbeat is None or heartbeat == reported:
+            continue
+        blocked = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+        if blocked < LOOP_BLOCK_THRESHOLD:
+            continue
+        frame = sys._current_frames().get(loop_thread_id)
+        if frame is None:
+            return
+        reported = heartbeat
+        health_state["loop_blocks"] += 1
+        # Кадры выше колбэка, который сейчас выполняет цикл, неинтересны
+        frames = traceback.extract_stack(frame)
+        start = max((i + 1 for i, f in enumerate(frames) if f.filename.endswith(os.path.join("asyncio", "events.py"))),
+                    default=0)
+        stack = "".join(traceback.format_list(frames[start:][-15:]))
+        logging.warning("Цикл событий заблокирован уже %.2f с, стек:\n%s", blocked, stack)
+
+def start_loop_watchdog():
+    threading.Thread(
+        target=watch_loop_blocks, args=(threading.get_ident(),), name="loop-watchdog", daemon=True
+    ).start()
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def health_snapshot() -> dict:
+    now = time.monotonic()
+
+    def age(key):
+        value = health_state[key]
+        return None if value is None else round(now - value, 3)
+
+    oldest_render = min(render_jobs.values(), default=None)
+    snapshot = {
+        "uptime": round(now - health_state["started"], 1),
+        "since_last_update": age("last_update"),
+        "since_last_poll": age("last_poll"),
+        "loop_lag": round(loop_lag_samples[-1], 4) if loop_lag_samples else None,
+        "loop_lag_max_1m": round(max(loop_lag_samples, default=0.0), 4),
+        "loop_lag_p50": round(percentile(loop_lag_samples, 0.5) or 0.0, 4),
+        "loop_lag_p95": round(percentile(loop_lag_samples, 0.95) or 0.0, 4),
+        "loop_lag_p99": round(percentile(loop_lag_samples, 0.99) or 0.0, 4),
+        "loop_blocks": health_state["loop_blocks"],
+        "render_queue": len(render_jobs),
+        "render_oldest": None if oldest_render is None else round(now - oldest_render, 1),
+        "outbox_backlog": health_state["outbox_pending"] + health_state["outbox_waiting"],
+        "overlay_cache": OVERLAY_CACHE.snapshot(),
+        "image_memory": IMAGE_MEMORY.snapshot(),
     }
-    for op in openings:
-        copy_op = dict(op)
-        copy_op["photo"] = "есть" if copy_op["photos"] else "нет"
-        client_data["openings"].append(copy_op)
-    image_data = generate_measurement_image(client_data)
-    caption_text = f"Имя: {name}\nТелефон: {phone}\nАдрес: {address}"
-    await update.message.reply_photo(photo=image_data, caption=caption_text)
-    keyboard = [
-        [KeyboardButton("Редактировать замер")],
-        [KeyboardButton("Завершить замер")],
-        [KeyboardButton(CANCEL_TEXT)]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Проверьте замер. Если всё правильно – нажмите 'Завершить замер', иначе – 'Редактировать замер'.", reply_markup=markup)
-    return CHECK_MEASURE
+    problems = []
+    if snapshot["since_last_poll"] is None or snapshot["since_last_poll"] > READY_MAX_POLL_AGE:
+        problems.append("getUpdates не отвечал дольше READY_MAX_POLL_AGE")
+    if snapshot["loop_lag_max_1m"] > READY_MAX_LOOP_LAG:
+        problems.append("цикл событий блокируется дольше READY_MAX_LOOP_LAG")
+    if snapshot["render_oldest"] is not None and snapshot["render_oldest"] > READY_MAX_RENDER_AGE:
+        problems.append("рендер выполняется дольше READY_MAX_RENDER_AGE")
+    snapshot["ready"] = not problems
+    snapshot["problems"] = problems
+    return snapshot
+
+async def handle_health_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?", 1)[0] if len(parts) > 1 else "/"
+        if path in ("/health", "/ready"):
+            snapshot = health_snapshot()
+            status = "200 OK" if path == "/health" or snapshot["ready"] else "503 Service Unavailable"
+            body = json.dumps(snapshot, ensure_ascii=False).encode()
+        else:
+            status, body = "404 Not Found", b'{"error": "not found"}'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logging.debug("Ошибка health-запроса: %s", e)
+    finally:
+        writer.close()
 
-async def check_measure_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == "Редактировать замер":
-        return await edit_choice(update, context)
-    elif text == "Завершить замер":
-        return await confirm_finish(update, context)
-    else:
-        await update.message.reply_text("Пожалуйста, выберите 'Редактировать замер' или 'Завершить замер'.")
-        return CHECK_MEASURE
+async def start_health_server():
+    server = await asyncio.start_server(handle_health_request, "0.0.0.0", HEALTH_PORT)
+    logging.info("Health-сервер слушает порт %s", HEALTH_PORT)
+    async with server:
+        await server.serve_forever()
 
-async def confirm_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    name = context.user_data.get("client_name", "")
-    phone = context.user_data.get("client_phone", "")
-    address = context.user_data.get("client_address", "")
-    openings = context.user_data.get("openings", [])
+# -------------------------------------------------------------------
+# НЕЗАВЕРШЁННЫЕ ЗАМЕРЫ
+# Замерщик, бросивший замер на полпути, держал бы openings и фото в памяти
+# вечно. Через SESSION_TTL_MIN минут бездействия черновик сохраняется в архив
+# со статусом 'draft', диалог завершается, а user_data освобождается; за
+# SESSION_WARNING_MIN минут до этого замерщик получает предупреждение. Сессия
+# без черновика (замер уже отправлен) просто перестаёт отслеживаться.
+# conversation_timeout у ConversationHandler требует JobQueue (APScheduler),
+# поэтому просроченные сессии ищет собственная фоновая задача.
+# -------------------------------------------------------------------
+SESSION_TTL_MIN = float(os.environ.get("SESSION_TTL_MIN", "120"))
+SESSION_WARNING_MIN = float(os.environ.get("SESSION_WARNING_MIN", "10"))
+session_activity = {}   # (chat_id, user_id) -> [время последнего апдейта, предупреждён ли]
+
+def touch_session(update: object):
+    if isinstance(update, Update) and update.effective_chat and update.effective_user:
+        session_activity[(update.effective_chat.id, update.effective_user.id)] = [time.monotonic(), False]
+
+def has_draft(user_data) -> bool:
+    return bool(user_data) and bool(
+        user_data.get("client_name") or user_data.get("openings") or user_data.get("current_opening")
+    )
+
+def draft_client_data(user_data) -> dict:
+    openings = list(user_data.get("openings", []))
+    if user_data.get("current_opening"):
+        openings.append(user_data["current_opening"])
     client_data = {
-        "client_name": name,
-        "client_phone": phone,
-        "client_address": address,
-        "openings": []
+        "client_name": user_data.get("client_name", ""),
+        "client_phone": user_data.get("client_phone", ""),
+        "client_address": user_data.get("client_address", ""),
+        "openings": openings
     }
-    for op in openings:
-        copy_op = dict(op)
-        copy_op["photo"] = "есть" if copy_op["photos"] else "нет"
-        client_data["openings"].append(copy_op)
-    image_data = generate_measurement_image(client_data)
-    caption_text = f"Имя: {name}\nТелефон: {phone}\nАдрес: {address}"
-    await context.bot.send_photo(chat_id=TARGET_CHAT_ID, photo=image_data, caption=caption_text)
-    photo_overlays = []
-    for i, op in enumerate(openings, start=1):
-        for j, file_id in enumerate(op["photos"], start=1):
-            overlay_text = f"Фото {j} проёма #{i} ({op['room']})"
-            photo_overlays.append((file_id, overlay_text))
-    if photo_overlays:
-        await send_photos_with_overlay_as_album(context, TARGET_CHAT_ID, photo_overlays)
-    keyboard = [[KeyboardButton("Новый замер")]]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Замер успешно отправлен в рабочий чат. Вы можете начать новый замер.", reply_markup=markup)
-    return MENU
-
-# -------------------------------------------------------------------
-# 10) РЕДАКТИРОВАНИЕ / УДАЛЕНИЕ
-# -------------------------------------------------------------------
-async def edit_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    openings = context.user_data.get("openings", [])
-    if not openings:
-        await update.message.reply_text("У вас нет добавленных проёмов.")
-        return OPENING_MENU
-    kb = []
-    for i, op in enumerate(openings, start=1):
-        kb.append([KeyboardButton(f"Проём {i}: {op['room']}")])
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите проём для редактирования:", reply_markup=markup)
-    return EDIT_CHOICE
-
-async def edit_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    parts = text.split()
-    if len(parts) < 2 or parts[0] != "Проём":
-        await update.message.reply_text("Неверный формат. Выберите проём из списка.")
-        return EDIT_CHOICE
-    number_str = parts[1].rstrip(":")
-    try:
-        number = int(number_str)
-        index = number - 1
-        openings = context.user_data["openings"]
-        if index < 0 or index >= len(openings):
-            raise ValueError
-    except:
-        await update.message.reply_text("Неверный выбор проёма.")
-        return EDIT_CHOICE
-    context.user_data["edit_index"] = index
-    fields = [
-        "Комната", "Тип двери", "Размеры", "Полотно",
-        "Добор", "Кол-во доборов", "Наличники",
-        "Порог", "Демонтаж", "Открывание", "Комментарий"
-    ]
-    kb = [[KeyboardButton(f)] for f in fields] + [[KeyboardButton("Готово")]]
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите поле для изменения:", reply_markup=markup)
-    return EDIT_FIELD
-
-async def edit_field_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == "готово":
-        return await opening_menu_return(update, context)
-    field_map = {
-        "комната": "room",
-        "тип двери": "door_type",
-        "размеры": "dimensions",
-        "полотно": "canvas",
-        "добор": "dobor",
-        "кол-во доборов": "dobor_count",
-        "наличники": "nalichniki",
-        "порог": "threshold",
-        "демонтаж": "demontage",
-        "открывание": "opening",
-        "комментарий": "comment"
-    }
-    if text not in field_map:
-        await update.message.reply_text("Выберите поле из списка или 'Готово'.")
-        return EDIT_FIELD
-    context.user_data["edit_field"] = field_map[text]
-    await update.message.reply_text(f"Введите новое значение для «{text}»:")
-    return EDIT_VALUE
-
-async def edit_value_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    new_value = update.message.text
-    index = context.user_data["edit_index"]
-    field = context.user_data["edit_field"]
-    openings = context.user_data["openings"]
-    openings[index][field] = new_value
-    await update.message.reply_text(f"Поле «{field}» обновлено на: {new_value}.")
-    fields = [
-        "Комната", "Тип двери", "Размеры", "Полотно",
-        "Добор", "Кол-во доборов", "Наличники",
-        "Порог", "Демонтаж", "Открывание", "Комментарий"
-    ]
-    kb = [[KeyboardButton(f)] for f in fields] + [[KeyboardButton("Готово")]]
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите поле для изменения ещё или нажмите 'Готово':", reply_markup=markup)
-    return EDIT_FIELD
-
-async def opening_menu_return(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [KeyboardButton("Следующий проём")],
-        [KeyboardButton("Редактировать проём"), KeyboardButton("Удалить проём")],
-        [KeyboardButton("Проверить и завершить")]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Что делаем дальше?", reply_markup=markup)
-    return OPENING_MENU
-
-async def delete_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    openings = context.user_data.get("openings", [])
-    if not openings:
-        await update.message.reply_text("У вас нет добавленных проёмов.")
-        return OPENING_MENU
-    kb = []
-    for i, op in enumerate(openings, start=1):
-        kb.append([KeyboardButton(f"Проём {i}: {op['room']}")])
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите проём для удаления:", reply_markup=markup)
-    return DELETE_CHOICE
-
-async def delete_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    parts = text.split()
-    if len(parts) < 2 or parts[0] != "Проём":
-        await update.message.reply_text("Неверный формат. Выберите проём из списка.")
-        return DELETE_CHOICE
-    number_str = parts[1].rstrip(":")
-    try:
-        number = int(number_str)
-        index = number - 1
-        openings = context.user_data["openings"]
-        if index < 0 or index >= len(openings):
-            raise ValueError
-    except:
-        await update.message.reply_text("Неверный выбор проёма.")
-        return DELETE_CHOICE
-    context.user_data["delete_index"] = index
-    proem = context.user_data["openings"][index]
-    kb = [[KeyboardButton("Да, удалить"), KeyboardButton("Отмена")]]
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text(f"Вы уверены, что хотите удалить «Проём {number}: {proem['room']}»?", reply_markup=markup)
-    return DELETE_CONFIRM
-
-async def delete_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == "да, удалить":
-        index = context.user_data["delete_index"]
-        proem = context.user_data["openings"].pop(index)
-        await update.message.reply_text(f"Проём «{proem['room']}» удалён.")
-    else:
-        await update.message.reply_text("Удаление отменено.")
-    return await opening_menu_return(update, context)
-
-# -------------------------------------------------------------------
-# 11) /Отмена – кнопка "Отключить бот"
-# -------------------------------------------------------------------
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Диалог отменён. Бот отключён. Для повторного запуска нажмите 'Запустить'.")
-    return ConversationHandler.END
-
-async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Непредвиденная команда или сообщение. Диалог завершён.\nНажмите 'Запустить', чтобы начать заново.")
-    return ConversationHandler.END
-
-# -------------------------------------------------------------------
-# 12) ОСНОВНАЯ ФУНКЦИЯ АВТОРИЗАЦИИ – запуск и обработка контакта
-# -------------------------------------------------------------------
-async def start_auth(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Entry point для авторизации – вместо /start показываем кнопку "Запустить"
-    keyboard = [
-        [KeyboardButton(LAUNCH_TEXT)],
-        [KeyboardButton(CANCEL_TEXT)]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Нажмите 'Запустить' для авторизации.", reply_markup=markup)
-    return MENU
-
-async def menu_auth_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == LAUNCH_TEXT:
-        return await auth_request(update, context)
-    elif text == CANCEL_TEXT:
-        return await cancel(update, context)
-    else:
-        await update.message.reply_text("Нажмите 'Запустить' для авторизации или 'Отключить бот' для отмены.")
-        return MENU
-
-# -------------------------------------------------------------------
-# 13) ЭТАП АВТОРИЗАЦИИ: запрашиваем контакт
-# -------------------------------------------------------------------
-async def auth_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [KeyboardButton("Поделиться контактом", request_contact=True)],
-        [KeyboardButton(CANCEL_TEXT)]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Для авторизации поделитесь, пожалуйста, своим контактом.", reply_markup=markup)
-    return AUTH
-
-async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    contact = update.message.contact
-    if not contact:
-        await update.message.reply_text("Контакт не получен. Попробуйте ещё раз.")
-        return AUTH
-    # Нормализуем номер (оставляем только цифры)
-    phone = re.sub(r"\D", "", contact.phone_number)
-    if phone in ALLOWED_NUMBERS:
-        name = ALLOWED_NUMBERS[phone]
-        context.user_data["authorized_name"] = name
-        greeting = f"Здравствуйте, {name}! Для начала замера нажмите 'Новый замер' или 'Отключить бот' для отмены."
-        keyboard = [
-            [KeyboardButton("Новый замер")],
-            [KeyboardButton(CANCEL_TEXT)]
-        ]
-        markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text(greeting, reply_markup=markup)
-        return MENU
-    else:
-        await update.message.reply_text("Извините, ваш номер не найден в базе. Доступ закрыт.")
-        return ConversationHandler.END
-
-# -------------------------------------------------------------------
-# 14) ОСНОВНАЯ ЛОГИКА ЗАМЕРА (остальные функции остаются без изменений)
-# -------------------------------------------------------------------
-async def menu_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if text == "Новый замер":
-        context.user_data["openings"] = []
-        context.user_data.pop("client_name", None)
-        context.user_data.pop("client_phone", None)
-        context.user_data.pop("client_address", None)
-        await update.message.reply_text("Введите имя клиента:", reply_markup=ReplyKeyboardRemove())
-        return GET_NAME
-    else:
-        await update.message.reply_text("Нажмите кнопку 'Новый замер'.")
-        return MENU
-
-async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["client_name"] = update.message.text
-    await update.message.reply_text("Введите телефон клиента:")
-    return GET_PHONE
-
-async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["client_phone"] = update.message.text
-    await update.message.reply_text("Введите адрес клиента:")
-    return GET_ADDRESS
-
-async def get_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["client_address"] = update.message.text
-    return await start_opening(update, context)
-
-async def start_opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"] = {
-        "room": "",
-        "door_type": "",
-        "dimensions": "",
-        "canvas": "---",
-        "dobor": "---",
-        "dobor_count": "---",
-        "nalichniki": "---",
-        "threshold": "",
-        "demontage": "",
-        "opening": "---",
-        "comment": "",
-        "photos": []
-    }
-    await update.message.reply_text("Введите название комнаты (например, 'Кухня'):", reply_markup=ReplyKeyboardRemove())
-    return ENTER_ROOM
-
-async def enter_room(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["room"] = update.message.text
-    door_types = [
-        ["Межкомнатная дверь"],
-        ["Скрытая дверь"],
-        ["Входная дверь"],
-        ["Облагораживание проема"],
-        ["Складная дверь (книжка)"],
-        ["Раздвижная дверь (одностворчатая)"],
-        ["Раздвижная дверь (двустворчатая)"],
-        ["Двустворчатая дверь (распашная)"],
-        ["Иное"]
-    ]
-    door_types.append([CANCEL_TEXT])
-    markup = ReplyKeyboardMarkup(door_types, resize_keyboard=True)
-    await update.message.reply_text("Выберите тип двери:", reply_markup=markup)
-    return ENTER_DOOR_TYPE
-
-async def enter_door_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if text == "Иное":
-        await update.message.reply_text("Введите ваш вариант типа двери:", reply_markup=ReplyKeyboardRemove())
-        return ENTER_DOOR_TYPE_CUSTOM
-    else:
-        context.user_data["current_opening"]["door_type"] = text
-        await update.message.reply_text("Введите размеры проёма (высота, ширина, толщина стены):", reply_markup=ReplyKeyboardRemove())
-        return ENTER_DIMENSIONS
-
-async def enter_door_type_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["door_type"] = update.message.text
-    await update.message.reply_text("Введите размеры проёма (высота, ширина, толщина стены):", reply_markup=ReplyKeyboardRemove())
-    return ENTER_DIMENSIONS
-
-async def enter_dimensions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["dimensions"] = update.message.text
-    door_type = context.user_data["current_opening"]["door_type"]
-    if door_type == "Облагораживание проема":
-        context.user_data["current_opening"]["canvas"] = "---"
-        return await ask_dobor(update, context)
-    else:
-        canvas_variants = [
-            ["600", "700", "800", "Иное"],
-            [CANCEL_TEXT]
-        ]
-        markup = ReplyKeyboardMarkup(canvas_variants, resize_keyboard=True)
-        await update.message.reply_text("Введите рекомендуемое полотно:", reply_markup=markup)
-        return ENTER_CANVAS
-
-async def enter_canvas(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if text == "Иное":
-        await update.message.reply_text("Введите ваш вариант полотна:", reply_markup=ReplyKeyboardRemove())
-        return ENTER_CANVAS
-    else:
-        context.user_data["current_opening"]["canvas"] = text
-        return await ask_dobor(update, context)
-
-async def ask_dobor(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    dobor_variants = [
-        ["100 мм", "150 мм"],
-        ["200 мм", "нет"],
-        ["Иное"]
-    ]
-    dobor_variants.append([CANCEL_TEXT])
-    markup = ReplyKeyboardMarkup(dobor_variants, resize_keyboard=True)
-    await update.message.reply_text("Введите ширину добора:", reply_markup=markup)
-    return ENTER_DOBOR
-
-async def get_dobor(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == CANCEL_TEXT.lower():
-        return await cancel(update, context)
-    if text == "иное":
-        await update.message.reply_text("Введите ваш вариант добора:", reply_markup=ReplyKeyboardRemove())
-        return ENTER_DOBOR_CUSTOM
-    elif text in ["100 мм", "150 мм", "200 мм", "нет"]:
-        context.user_data["current_opening"]["dobor"] = text
-        if text == "нет":
-            context.user_data["current_opening"]["dobor_count"] = "---"
-            return await ask_nalichniki(update, context)
-        else:
-            dobor_count_variants = [
-                ["1,5", "2,5", "3", "нет"],
-                ["Иное"]
-            ]
-            dobor_count_variants.append([CANCEL_TEXT])
-            markup = ReplyKeyboardMarkup(dobor_count_variants, resize_keyboard=True)
-            await update.message.reply_text("Введите кол-во доборов:", reply_markup=markup)
-            return ENTER_DOBOR_COUNT
-    else:
-        await update.message.reply_text("Выберите один из вариантов или 'Иное'.")
-        return ENTER_DOBOR
-
-async def enter_dobor_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["dobor"] = update.message.text
-    dobor_count_variants = [
-        ["1,5", "2,5", "3", "нет"],
-        ["Иное"]
-    ]
-    dobor_count_variants.append([CANCEL_TEXT])
-    markup = ReplyKeyboardMarkup(dobor_count_variants, resize_keyboard=True)
-    await update.message.reply_text("Введите кол-во доборов:", reply_markup=markup)
-    return ENTER_DOBOR_COUNT
-
-async def enter_dobor_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == CANCEL_TEXT.lower():
-        return await cancel(update, context)
-    if text == "иное":
-        await update.message.reply_text("Введите ваш вариант кол-ва доборов:", reply_markup=ReplyKeyboardRemove())
-        return ENTER_DOBOR_COUNT_CUSTOM
-    elif text in ["1,5", "2,5", "3", "нет"]:
-        context.user_data["current_opening"]["dobor_count"] = text
-        return await ask_nalichniki(update, context)
-    else:
-        await update.message.reply_text("Выберите один из вариантов или 'Иное'.")
-        return ENTER_DOBOR_COUNT
-
-async def enter_dobor_count_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["dobor_count"] = update.message.text
-    return await ask_nalichniki(update, context)
-
-async def ask_nalichniki(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    door_type = context.user_data["current_opening"]["door_type"]
-    if door_type in ["Скрытая дверь", "Входная дверь"]:
-        context.user_data["current_opening"]["nalichniki"] = "---"
-        return await ask_threshold(update, context)
-    else:
-        variants = [
-            ["2,5"],
-            ["5"],
-            ["5,5"],   # Добавленная кнопка "5,5"
-            ["6"],
-            ["нет"],
-            ["Иное"]
-        ]
-        variants.append([CANCEL_TEXT])
-        markup = ReplyKeyboardMarkup(variants, resize_keyboard=True)
-        await update.message.reply_text("Введите кол-во наличников:", reply_markup=markup)
-        return ENTER_NALICHNIKI_CHOICE
-
-async def enter_nalichniki_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == CANCEL_TEXT.lower():
-        return await cancel(update, context)
-    if text == "иное":
-        await update.message.reply_text("Введите ваш вариант кол-ва наличников:", reply_markup=ReplyKeyboardRemove())
-        return ENTER_NALICHNIKI_CUSTOM
-    elif text in ["2,5", "5", "5,5", "6", "нет"]:
-        context.user_data["current_opening"]["nalichniki"] = text
-        return await ask_threshold(update, context)
-    else:
-        await update.message.reply_text("Выберите один из вариантов или 'Иное'.")
-        return ENTER_NALICHNIKI_CHOICE
-
-async def enter_nalichniki_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["nalichniki"] = update.message.text
-    return await ask_threshold(update, context)
-
-async def ask_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    door_type = context.user_data["current_opening"]["door_type"]
-    if door_type == "Облагораживание проема":
-        context.user_data["current_opening"]["threshold"] = "---"
-        return await ask_demontage(update, context)
-    else:
-        btns = [
-            ["да", "нет"],
-            [CANCEL_TEXT]
-        ]
-        markup = ReplyKeyboardMarkup(btns, resize_keyboard=True)
-        await update.message.reply_text("Наличие порога?", reply_markup=markup)
-        return ENTER_THRESHOLD_CHOICE
-
-async def threshold_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == CANCEL_TEXT.lower():
-        return await cancel(update, context)
-    if text in ["да", "нет"]:
-        context.user_data["current_opening"]["threshold"] = text
-        return await ask_demontage(update, context)
-    else:
-        await update.message.reply_text("Выберите 'да' или 'нет'.")
-        return ENTER_THRESHOLD_CHOICE
-
-async def ask_demontage(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    btns = [
-        ["да", "нет"],
-        [CANCEL_TEXT]
-    ]
-    markup = ReplyKeyboardMarkup(btns, resize_keyboard=True)
-    await update.message.reply_text("Демонтаж старой двери?", reply_markup=markup)
-    return ENTER_DEMONTAGE_CHOICE
-
-async def demontage_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == CANCEL_TEXT.lower():
-        return await cancel(update, context)
-    if text not in ["да", "нет"]:
-        await update.message.reply_text("Выберите 'да' или 'нет'.")
-        return ENTER_DEMONTAGE_CHOICE
-    context.user_data["current_opening"]["demontage"] = text
-    return await ask_opening(update, context)
-
-async def ask_opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    door_type = context.user_data["current_opening"]["door_type"]
-    if door_type in ["Облагораживание проема", "Складная дверь (книжка)", "Раздвижная дверь (одностворчатая)",
-                     "Раздвижная дверь (двустворчатая)", "Двустворчатая дверь (распашная)"]:
-        context.user_data["current_opening"]["opening"] = "---"
-        return await ask_comment(update, context)
-    else:
-        variants = [
-            ["Левое", "Правое"],
-            ["Левое рев.", "Правое рев."],
-            ["Иное"]
-        ]
-        variants.append([CANCEL_TEXT])
-        markup = ReplyKeyboardMarkup(variants, resize_keyboard=True)
-        await update.message.reply_text("Введите открывание:", reply_markup=markup)
-        return ENTER_OPENING_CHOICE
-
-async def opening_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if text == "Иное":
-        await update.message.reply_text("Введите ваш вариант открывания:", reply_markup=ReplyKeyboardRemove())
-        return ENTER_OPENING_CUSTOM
-    elif text in ["Левое", "Правое", "Левое рев.", "Правое рев."]:
-        context.user_data["current_opening"]["opening"] = text
-        return await ask_comment(update, context)
-    else:
-        await update.message.reply_text("Выберите один из вариантов или 'Иное'.")
-        return ENTER_OPENING_CHOICE
-
-async def opening_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    context.user_data["current_opening"]["opening"] = update.message.text
-    return await ask_comment(update, context)
-
-async def ask_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [KeyboardButton(SKIP_TEXT)],
-        [CANCEL_TEXT]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Введите комментарий или нажмите «Пропустить»:", reply_markup=markup)
-    return ENTER_COMMENT
-
-async def enter_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if text == SKIP_TEXT:
-        context.user_data["current_opening"]["comment"] = ""
-    else:
-        context.user_data["current_opening"]["comment"] = text
-    keyboard = [
-        [KeyboardButton(DONE_TEXT)],
-        [KeyboardButton(SKIP_TEXT)],
-        [CANCEL_TEXT]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Прикрепите фото (по одной). Когда закончите, нажмите «Готово». Если нет фото – «Пропустить».", reply_markup=markup)
-    return ENTER_PHOTOS
-
-async def enter_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if update.message.text in [SKIP_TEXT, DONE_TEXT]:
-        return await save_opening(update, context)
-    if update.message.photo:
-        file_id = update.message.photo[-1].file_id
-        context.user_data["current_opening"]["photos"].append(file_id)
-        await update.message.reply_text("Фото сохранено. Можете отправить ещё, или нажмите «Готово».")
-        return ENTER_PHOTOS
+    return client_data
+
+def conversation_active(conv_handler: ConversationHandler, key: tuple) -> bool:
+    # Публичного доступа к состояниям диалога в PTB 20 нет
+    return key in conv_handler._conversations
+
+def user_in_conversation(conv_handler: ConversationHandler, user_id: int) -> bool:
+    # user_data общий для всех чатов пользователя: пока он ведёт диалог хоть
+    # в одном чате (например, /find в рабочем чате, а замер — в личке), его
+    # данные освобождать нельзя
+    return any(key[-1] == user_id for key in conv_handler._conversations)
+
+async def expire_session(application: Application, conv_handler: ConversationHandler, key: tuple):
+    chat_id, user_id = key
+    user_data = application.user_data.get(user_id)
+    pending = user_data.get("pending_measurement") if user_data else None
+    if not pending and not has_draft(user_data):
+        # Замер завершён штатно (или не начат): сохранять нечего, замерщик
+        # остаётся авторизованным в меню и не получает сообщений
+        cancel_album_acks(chat_id)
+        session_activity.pop(key, None)
+        return
+    text = "Сессия закрыта из-за бездействия."
+    if pending:
+        # Замер уже в архиве, не ушла только отправка — второй записи-черновика не нужно
+        text = (f"Замер #{pending[0]} сохранён в архив, но не был отправлен в рабочий чат. "
+                f"Отправить его можно командой /resend {pending[0]}.")
     else:
-        await update.message.reply_text("Отправьте фото, либо нажмите «Готово» или «Пропустить».")
-        return ENTER_PHOTOS
-
-async def save_opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    current = context.user_data["current_opening"]
-    context.user_data["openings"].append(current)
-    keyboard = [
-        [KeyboardButton("Следующий проём")],
-        [KeyboardButton("Редактировать проём"), KeyboardButton("Удалить проём")],
-        [KeyboardButton("Проверить и завершить")],
-        [CANCEL_TEXT]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Проём сохранён. Что делаем дальше?", reply_markup=markup)
-    return OPENING_MENU
-
-async def handle_opening_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == CANCEL_TEXT:
-        return await cancel(update, context)
-    if text == "Следующий проём":
-        return await start_opening(update, context)
-    elif text == "Редактировать проём":
-        return await edit_choice(update, context)
-    elif text == "Удалить проём":
-        return await delete_choice(update, context)
-    elif text == "Проверить и завершить":
-        return await check_measure(update, context)
-    else:
-        await update.message.reply_text("Выберите: «Следующий проём», «Редактировать проём», «Удалить проём» или «Проверить и завершить».")
-        return OPENING_MENU
+        try:
+            measurement_id = archive_measurement(
+                draft_client_data(user_data),
+                installer=user_data.get("authorized_name", ""),
+                installer_id=user_id,
+                status="draft"
+            )
+            logging.info("Незавершённый замер сохранён в архив как черновик #%s", measurement_id)
+            text = (f"Замер не был завершён и закрыт из-за бездействия. "
+                    f"Черновик сохранён в архив: #{measurement_id}.")
+        except Exception as e:
+            logging.error("Ошибка сохранения черновика в архив: %s", e)
+    conv_handler._conversations.pop(key, None)
+    cancel_album_acks(chat_id)
+    if not user_in_conversation(conv_handler, user_id):
+        drop_preview(user_id)
+        application.drop_user_data(user_id)
+    session_activity.pop(key, None)
+    markup = ReplyKeyboardMarkup([[KeyboardButton(LAUNCH_TEXT)]], resize_keyboard=True)
+    try:
+        await application.bot.send_message(chat_id, f"{text}\nДля нового замера нажмите «{LAUNCH_TEXT}».",
+                                           reply_markup=markup)
+    except Exception as e:
+        logging.error("Не удалось уведомить о закрытии сессии: %s", e)
+
+async def expire_idle_session(application: Application, conv_handler: ConversationHandler, key: tuple,
+                              entry: list, ttl: float, warning: float):
+    idle = time.monotonic() - entry[0]
+    if idle < ttl - warning:
+        return
+    chat_id, user_id = key
+    if not conversation_active(conv_handler, key):
+        # Диалог уже завершён (отмена, конец замера) — просто освобождаем память
+        if idle >= ttl:
+            if not user_in_conversation(conv_handler, user_id):
+                drop_preview(user_id)
+                application.drop_user_data(user_id)
+            session_activity.pop(key, None)
+        return
+    if idle >= ttl:
+        await expire_session(application, conv_handler, key)
+    elif not entry[1] and has_draft(application.user_data.get(user_id)):
+        entry[1] = True
+        minutes = max(1, round((ttl - idle) / 60))
+        try:
+            await application.bot.send_message(
+                chat_id,
+                f"Замер не завершён. Если ничего не вводить, через {minutes} мин. он будет "
+                f"закрыт, а черновик сохранён в архив."
+            )
+        except Exception as e:
+            logging.error("Не удалось отправить предупреждение о таймауте: %s", e)
+
+async def expire_idle_sessions(application: Application):
+    conv_handler = next(h for h in application.handlers[0] if isinstance(h, ConversationHandler))
+    ttl = SESSION_TTL_MIN * 60
+    warning = min(SESSION_WARNING_MIN * 60, ttl)
+    interval = max(1.0, min(60.0, warning / 2 if warning else ttl / 2))
+    while True:
+        await asyncio.sleep(interval)
+        for key, entry in list(session_activity.items()):
+            if time.monotonic() - entry[0] < ttl - warning:
+                continue
+            # Пока обходим список и ждём отправки сообщений, замерщик мог вернуться:
+            # действуем в очереди его чата и только если с тех пор апдейтов не было
+            async with application.chat_lock(key[0]):
+                if session_activity.get(key) is entry:
+                    await expire_idle_session(application, conv_handler, key, entry, ttl, warning)
 
 # -------------------------------------------------------------------
-# ЭТАП ПРОВЕРКИ: "Проверить и завершить"
+# ПРОФИЛИРОВАНИЕ ОБРАБОТЧИКОВ (включается переменной PROFILE_DIR)
+# Каждый обработчик диалога оборачивается cProfile. Если обработка апдейта
+# заняла дольше PROFILE_THRESHOLD_MS, профиль сохраняется в PROFILE_DIR с
+# состоянием и именем обработчика в имени файла. Сводка по всем файлам:
+# `python bot.py --profile-report`.
+# cProfile действует на весь поток, поэтому одновременно профилируется
+# только один апдейт, а в профиль попадает и то, что цикл событий выполнял
+# во время его ожиданий. Рендер в пуле потоков в профиль не попадает —
+# он виден как ожидание run_in_render_pool.
 # -------------------------------------------------------------------
-async def check_measure(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    name = context.user_data.get("client_name", "")
-    phone = context.user_data.get("client_phone", "")
-    address = context.user_data.get("client_address", "")
-    openings = context.user_data.get("openings", [])
-    client_data = {
-        "client_name": name,
-        "client_phone": phone,
-        "client_address": address,
-        "openings": []
-    }
-    for op in openings:
-        copy_op = dict(op)
-        copy_op["photo"] = "есть" if copy_op["photos"] else "нет"
-        client_data["openings"].append(copy_op)
-    image_data = generate_measurement_image(client_data)
-    caption_text = f"Имя: {name}\nТелефон: {phone}\nАдрес: {address}"
-    await update.message.reply_photo(photo=image_data, caption=caption_text)
-    keyboard = [
-        [KeyboardButton("Редактировать замер")],
-        [KeyboardButton("Завершить замер")],
-        [CANCEL_TEXT]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Проверьте замер. Если всё правильно – нажмите 'Завершить замер', иначе – 'Редактировать замер'.", reply_markup=markup)
-    return CHECK_MEASURE
-
-async def check_measure_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text
-    if text == "Редактировать замер":
-        return await edit_choice(update, context)
-    elif text == "Завершить замер":
-        return await confirm_finish(update, context)
-    else:
-        await update.message.reply_text("Пожалуйста, выберите 'Редактировать замер' или 'Завершить замер'.")
-        return CHECK_MEASURE
-
-async def confirm_finish(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text == CANCEL_TEXT:
-        return await cancel(update, context)
-    name = context.user_data.get("client_name", "")
-    phone = context.user_data.get("client_phone", "")
-    address = context.user_data.get("client_address", "")
-    openings = context.user_data.get("openings", [])
-    client_data = {
-        "client_name": name,
-        "client_phone": phone,
-        "client_address": address,
-        "openings": []
-    }
-    for op in openings:
-        copy_op = dict(op)
-        copy_op["photo"] = "есть" if copy_op["photos"] else "нет"
-        client_data["openings"].append(copy_op)
-    image_data = generate_measurement_image(client_data)
-    caption_text = f"Имя: {name}\nТелефон: {phone}\nАдрес: {address}"
-    await context.bot.send_photo(chat_id=TARGET_CHAT_ID, photo=image_data, caption=caption_text)
-    photo_overlays = []
-    for i, op in enumerate(openings, start=1):
-        for j, file_id in enumerate(op["photos"], start=1):
-            overlay_text = f"Фото {j} проёма #{i} ({op['room']})"
-            photo_overlays.append((file_id, overlay_text))
-    if photo_overlays:
-        await send_photos_with_overlay_as_album(context, TARGET_CHAT_ID, photo_overlays)
-    keyboard = [[KeyboardButton("Новый замер")]]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Замер успешно отправлен в рабочий чат. Вы можете начать новый замер.", reply_markup=markup)
-    return MENU
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+PROFILE_THRESHOLD_MS = float(os.environ.get("PROFILE_THRESHOLD_MS", "250"))
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "1"))
+profile_state = {"busy": False, "saved": 0}
+
+def profiled(callback, state_name: str):
+    import cProfile
+    import random
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        if profile_state["busy"] or random.random() >= PROFILE_SAMPLE_RATE:
+            return await callback(update, context)
+        profile_state["busy"] = True
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            return await callback(update, context)
+        finally:
+            profiler.disable()
+            profile_state["busy"] = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms >= PROFILE_THRESHOLD_MS:
+                name = f"{datetime.now():%Y%m%d-%H%M%S}_{elapsed_ms:.0f}ms_{state_name}_{callback.__name__}.prof"
+                try:
+                    os.makedirs(PROFILE_DIR, exist_ok=True)
+                    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+                    profile_state["saved"] += 1
+                except OSError as e:
+                    logging.error("Не удалось сохранить профиль: %s", e)
+    return wrapper
+
+def profile_conversation(conv_handler: ConversationHandler):
+    for handler in conv_handler.entry_points:
+        handler.callback = profiled(handler.callback, "ENTRY")
+    for state, handlers in conv_handler.states.items():
+        for handler in handlers:
+            handler.callback = profiled(handler.callback, STATE_NAMES.get(state, str(state)))
+    for handler in conv_handler.fallbacks:
+        handler.callback = profiled(handler.callback, "FALLBACK")
+    logging.info("Профилирование включено: апдейты дольше %.0f мс сохраняются в %s",
+                 PROFILE_THRESHOLD_MS, PROFILE_DIR)
+
+def print_profile_report(directory: str, top: int = 25):
+    """Сводка по сохранённым профилям: медленные обработчики и горячие функции."""
+    import pstats
+    files = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".prof")
+    ) if os.path.isdir(directory) else []
+    if not files:
+        print(f"В {directory} нет профилей")
+        return
+    by_handler = {}
+    for path in files:
+        match = re.match(r"[\d-]+_(\d+)ms_(.+)\.prof$", os.path.basename(path))
+        if match:
+            stats = by_handler.setdefault(match.group(2), [0, 0, 0])
+            elapsed = int(match.group(1))
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+    print(f"Профилей: {len(files)}\n")
+    print("Медленные апдейты по обработчикам (состояние_обработчик):")
+    for name, (count, total, worst) in sorted(by_handler.items(), key=lambda item: -item[1][1]):
+        print(f"  {count:5d} шт  всего {total:8d} мс  макс {worst:6d} мс  {name}")
+    stats = pstats.Stats(*files)
+    stats.strip_dirs()
+    stats.files = []   # иначе pstats печатает перед каждой таблицей список всех файлов
+    print(f"\nГорячие функции по собственному времени (топ-{top}):")
+    stats.sort_stats("tottime").print_stats(top)
+    print(f"Горячие функции по накопленному времени (топ-{top}):")
+    stats.sort_stats("cumulative").print_stats(top)
 
 # -------------------------------------------------------------------
-# РЕДАКТИРОВАНИЕ / УДАЛЕНИЕ
+# ЗАПИСЬ И ВОСПРОИЗВЕДЕНИЕ АПДЕЙТОВ
+# RECORD_UPDATES=путь.jsonl — каждый входящий апдейт дописывается в файл
+# строкой {"t": секунды от старта записи, "update": ...} в обезличенном виде:
+# id пользователей и чатов заменяются псевдонимами, имена — на U<n>, номера
+# телефонов — на фиктивные, а в тексте маскируются слова, которых нет на
+# кнопках бота (нажатия кнопок остаются, имена клиентов и адреса
+# превращаются в «ххххх» той же длины), и цифры телефонов в любом месте. Маскировка детерминирована, поэтому
+# кнопки «Проём 1: ххххх» совпадают с введёнными ранее названиями.
+# `python bot.py --replay путь.jsonl --speed 10` прогоняет запись через
+# настоящие обработчики и рендер, но вместо Bot API отвечает заглушка.
 # -------------------------------------------------------------------
-async def edit_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    openings = context.user_data.get("openings", [])
-    if not openings:
-        await update.message.reply_text("У вас нет добавленных проёмов.")
-        return OPENING_MENU
-    kb = []
-    for i, op in enumerate(openings, start=1):
-        kb.append([KeyboardButton(f"Проём {i}: {op['room']}")])
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите проём для редактирования:", reply_markup=markup)
-    return EDIT_CHOICE
-
-async def edit_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    parts = text.split()
-    if len(parts) < 2 or parts[0] != "Проём":
-        await update.message.reply_text("Неверный формат. Выберите проём из списка.")
-        return EDIT_CHOICE
-    number_str = parts[1].rstrip(":")
-    try:
-        number = int(number_str)
-        index = number - 1
-        openings = context.user_data["openings"]
-        if index < 0 or index >= len(openings):
-            raise ValueError
-    except:
-        await update.message.reply_text("Неверный выбор проёма.")
-        return EDIT_CHOICE
-    context.user_data["edit_index"] = index
-    fields = [
-        "Комната", "Тип двери", "Размеры", "Полотно",
-        "Добор", "Кол-во доборов", "Наличники",
-        "Порог", "Демонтаж", "Открывание", "Комментарий"
-    ]
-    kb = [[KeyboardButton(f)] for f in fields] + [[KeyboardButton("Готово")]]
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите поле для изменения:", reply_markup=markup)
-    return EDIT_FIELD
-
-async def edit_field_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == "готово":
-        return await opening_menu_return(update, context)
-    field_map = {
-        "комната": "room",
-        "тип двери": "door_type",
-        "размеры": "dimensions",
-        "полотно": "canvas",
-        "добор": "dobor",
-        "кол-во доборов": "dobor_count",
-        "наличники": "nalichniki",
-        "порог": "threshold",
-        "демонтаж": "demontage",
-        "открывание": "opening",
-        "комментарий": "comment"
-    }
-    if text not in field_map:
-        await update.message.reply_text("Выберите поле из списка или 'Готово'.")
-        return EDIT_FIELD
-    context.user_data["edit_field"] = field_map[text]
-    await update.message.reply_text(f"Введите новое значение для «{text}»:")
-    return EDIT_VALUE
-
-async def edit_value_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    new_value = update.message.text
-    index = context.user_data["edit_index"]
-    field = context.user_data["edit_field"]
-    openings = context.user_data["openings"]
-    openings[index][field] = new_value
-    await update.message.reply_text(f"Поле «{field}» обновлено на: {new_value}.")
-    fields = [
-        "Комната", "Тип двери", "Размеры", "Полотно",
-        "Добор", "Кол-во доборов", "Наличники",
-        "Порог", "Демонтаж", "Открывание", "Комментарий"
-    ]
-    kb = [[KeyboardButton(f)] for f in fields] + [[KeyboardButton("Готово")]]
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите поле для изменения ещё или нажмите 'Готово':", reply_markup=markup)
-    return EDIT_FIELD
+RECORD_UPDATES = os.environ.get("RECORD_UPDATES", "")
+REPLAY_API_LATENCY = float(os.environ.get("REPLAY_API_LATENCY", "0.05"))
+record_state = {"started": None, "pseudonyms": {}, "phones": {}}
+
+def keyboard_labels(node) -> list:
+    """Строки списка-клавиатуры (список строк или список рядов строк); иначе []."""
+    if not isinstance(node, ast.List) or not node.elts:
+        return []
+    labels = []
+    for item in node.elts:
+        row = item.elts if isinstance(item, ast.List) else [item]
+        for cell in row:
+            if not (isinstance(cell, ast.Constant) and isinstance(cell.value, str)):
+                return []
+            labels.append(cell.value)
+    return labels
+
+@lru_cache(maxsize=1)
+def bot_vocabulary() -> frozenset:
+    # Только надписи кнопок и команды: константы *_TEXT, аргументы
+    # KeyboardButton и CommandHandler, списки-клавиатуры. Прочие литералы (подсказки, образцы для
+    # --render-check с именами и адресами) в белый список не попадают.
+    with open(os.path.abspath(__file__), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    labels = []
+    fixtures = {"RENDER_SAMPLES", "RENDER_PHOTO_SAMPLES", "SAMPLE_COMMENT_WORDS"}
+    nodes = (node for top in tree.body
+             if not (isinstance(top, ast.Assign) and any(getattr(t, "id", None) in fixtures for t in top.targets))
+             for node in ast.walk(top))
+    for node in nodes:
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and any(
+                isinstance(target, ast.Name) and target.id.endswith("_TEXT") for target in node.targets):
+            labels.append(str(node.value.value))
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+              and node.func.id in ("KeyboardButton", "InlineKeyboardButton", "CommandHandler") and node.args):
+            label = node.args[0]
+            parts = label.values if isinstance(label, ast.JoinedStr) else [label]
+            labels += [part.value for part in parts if isinstance(part, ast.Constant) and isinstance(part.value, str)]
+        else:
+            labels += keyboard_labels(node)
+    return frozenset(word.lower() for label in labels for word in re.findall(r"[A-Za-zА-Яа-яЁё]+", label))
 
-async def opening_menu_return(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [KeyboardButton("Следующий проём")],
-        [KeyboardButton("Редактировать проём"), KeyboardButton("Удалить проём")],
-        [KeyboardButton("Проверить и завершить")]
-    ]
-    markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Что делаем дальше?", reply_markup=markup)
-    return OPENING_MENU
+def mask_word(match) -> str:
+    word = match.group(0)
+    if word.lower() in bot_vocabulary():
+        return word
+    return re.sub(r"[А-Яа-яЁё]", "х", re.sub(r"[A-Za-z]", "x", word))
 
-async def delete_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    openings = context.user_data.get("openings", [])
-    if not openings:
-        await update.message.reply_text("У вас нет добавленных проёмов.")
-        return OPENING_MENU
-    kb = []
-    for i, op in enumerate(openings, start=1):
-        kb.append([KeyboardButton(f"Проём {i}: {op['room']}")])
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text("Выберите проём для удаления:", reply_markup=markup)
-    return DELETE_CHOICE
+# Похоже на телефон: от 7 цифр подряд, допускаются пробелы, дефисы, скобки и + в начале
+PHONE_LIKE_RE = re.compile(r"\+?\(?\d(?:[\s()-]*\d){6,}")
 
-async def delete_choice_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.strip()
-    parts = text.split()
-    if len(parts) < 2 or parts[0] != "Проём":
-        await update.message.reply_text("Неверный формат. Выберите проём из списка.")
-        return DELETE_CHOICE
-    number_str = parts[1].rstrip(":")
+def mask_phone(match) -> str:
+    text = match.group(0)
     try:
-        number = int(number_str)
-        index = number - 1
-        openings = context.user_data["openings"]
-        if index < 0 or index >= len(openings):
-            raise ValueError
-    except:
-        await update.message.reply_text("Неверный выбор проёма.")
-        return DELETE_CHOICE
-    context.user_data["delete_index"] = index
-    proem = context.user_data["openings"][index]
-    kb = [[KeyboardButton("Да, удалить"), KeyboardButton("Отмена")]]
-    markup = ReplyKeyboardMarkup(kb, resize_keyboard=True)
-    await update.message.reply_text(f"Вы уверены, что хотите удалить «Проём {number}: {proem['room']}»?", reply_markup=markup)
-    return DELETE_CONFIRM
-
-async def delete_confirm_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if text == "да, удалить":
-        index = context.user_data["delete_index"]
-        proem = context.user_data["openings"].pop(index)
-        await update.message.reply_text(f"Проём «{proem['room']}» удалён.")
-    else:
-        await update.message.reply_text("Удаление отменено.")
-    return await opening_menu_return(update, context)
+        # Размеры проёма («2050 810 120») тоже выглядят как цифры подряд — их оставляем
+        parse_dimensions(text)
+        return text
+    except ValueError:
+        return re.sub(r"\d", "0", text)
+
+def anonymize_text(text: str) -> str:
+    digits = re.sub(r"\D", "", text)
+    if 10 <= len(digits) <= 12 and digits[0] in "789" and not re.sub(r"[\d\s()+-]", "", text):
+        return "8" + "0" * (len(digits) - 1)
+    text = PHONE_LIKE_RE.sub(mask_phone, text)
+    return re.sub(r"[A-Za-zА-Яа-яЁё]+", mask_word, text)
+
+def pseudonym(real_id: int) -> int:
+    ids = record_state["pseudonyms"]
+    if abs(real_id) not in ids:
+        ids[abs(real_id)] = 100000 + len(ids)
+    return ids[abs(real_id)] if real_id > 0 else -ids[abs(real_id)]
+
+def anonymize_update(data):
+    if isinstance(data, list):
+        return [anonymize_update(item) for item in data]
+    if not isinstance(data, dict):
+        return data
+    result = {}
+    for key, value in data.items():
+        if key in ("id", "user_id") and isinstance(value, int):
+            result[key] = pseudonym(value)
+        elif key in ("first_name", "last_name", "title"):
+            result[key] = f"U{pseudonym(abs(data.get('id') or data.get('user_id') or 0)) % 100000}"
+        elif key in ("username", "vcard"):
+            continue
+        elif key == "phone_number":
+            phone = re.sub(r"\D", "", value)
+            phones = record_state["phones"]
+            if phone not in phones:
+                phones[phone] = f"7000{len(phones):07d}"
+            result[key] = phones[phone]
+            # Для воспроизведения важно лишь, пускал ли бот этот номер
+            result["allowed"] = phone in ALLOWED_NUMBERS
+        elif key in ("text", "caption") and isinstance(value, str):
+            result[key] = anonymize_text(value)
+        else:
+            result[key] = anonymize_update(value)
+    return result
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now = time.monotonic()
+    if record_state["started"] is None:
+        record_state["started"] = now
+    line = {"t": round(now - record_state["started"], 3), "update": anonymize_update(update.to_dict())}
+    try:
+        with open(RECORD_UPDATES, "a", encoding="utf-8") as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logging.error("Не удалось записать апдейт: %s", e)
+
+class ReplayRequest(BaseRequest):
+    """Заглушка Bot API для воспроизведения: отвечает правдоподобными объектами
+    с задержкой REPLAY_API_LATENCY и считает вызовы по методам. С files_dir
+    ведёт себя как локальный сервер (--local): getFile кладёт фото в этот
+    каталог и возвращает абсолютный путь."""
+
+    def __init__(self, files_dir: str = None):
+        self.calls = {}
+        self.message_id = 0
+        self.photo = None
+        self.files_dir = files_dir
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit("/", 1)[-1]
+        if is_file_download(url):
+            endpoint = "download"
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if REPLAY_API_LATENCY:
+            await asyncio.sleep(REPLAY_API_LATENCY)
+        if self.photo is None and endpoint in ("download", "getFile"):
+            self.photo = sample_photo_bytes((1280, 960))
+        if endpoint == "download":
+            return 200, self.photo
+        params = request_data.parameters if request_data else {}
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 0), "type": "private"},
+        }
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+        elif endpoint == "getFile":
+            file_id = params["file_id"]
+            file_path = f"photos/{file_id}.jpg"
+            if self.files_dir:
+                file_path = os.path.join(self.files_dir, file_path)
+                if not os.path.exists(file_path):
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    with open(file_path, "wb") as f:
+                        f.write(self.photo)
+            result = {"file_id": file_id, "file_unique_id": file_id[-16:], "file_path": file_path}
+        elif endpoint == "sendMediaGroup":
+            media = params["media"]
+            count = len(json.loads(media) if isinstance(media, str) else media)
+            result = [dict(message, message_id=self.message_id + i) for i in range(count)]
+            self.message_id += count
+        elif endpoint.startswith(("send", "edit")):
+            result = message
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class ReplayApplication(SerializedApplication):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations = []
+
+    async def process_update(self, update: object) -> None:
+        started = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            self.durations.append(time.perf_counter() - started)
+
+async def replay_updates(path: str, speed: float):
+    global TOKEN, ARCHIVE_DB_PATH, _archive_conn, OVERLAY_CACHE
+    with open(path, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for record in records:
+        contact = record["update"].get("message", {}).get("contact")
+        if contact and contact.pop("allowed", False):
+            ALLOWED_NUMBERS[contact["phone_number"]] = "Замерщик"
+    TOKEN = TOKEN or "0:replay"
+    # Архив и кэш фото — во временном каталоге: воспроизведение на рабочем
+    # сервере не должно добавлять замеры в /find, /search и /export
+    sandbox = tempfile.TemporaryDirectory()
+    if _archive_conn is not None:
+        _archive_conn.close()
+        _archive_conn = None
+    ARCHIVE_DB_PATH = os.path.join(sandbox.name, "archive.db")
+    OVERLAY_CACHE = OverlayCache(os.path.join(sandbox.name, "overlay_cache"), OVERLAY_CACHE.max_bytes)
+    # BOT_API_LOCAL_MODE=1 проверяет чтение файлов с диска локального сервера
+    files_dir = os.path.join(sandbox.name, "bot_api") if BOT_API_LOCAL_MODE else None
+    request = ReplayRequest(files_dir)
+    # Ограничитель частоты выключен: заглушка не требует пауз, а замер — про обработчики и рендер
+    app = build_application(request=request, application_class=ReplayApplication, rate_limit=False)
+    await app.initialize()
+    await app.start()
+    started = time.perf_counter()
+    for record in records:
+        if speed > 0:
+            delay = record["t"] / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await app.update_queue.put(Update.de_json(record["update"], app.bot))
+    await app.update_queue.join()
+    # Обработчики запускаются задачами; ждём, пока завершатся все, включая отложенные
+    while len(app.durations) < len(records) or render_jobs:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    await app.stop()
+    await app.shutdown()
+    if _archive_conn is not None:
+        _archive_conn.close()
+        _archive_conn = None
+    sandbox.cleanup()
+    durations = sorted(app.durations)
+    print(f"Апдейтов: {len(records)} за {elapsed:.2f} с (скорость x{speed:g})")
+    print(f"Апдейт с ожиданием очереди своего чата: p50 {percentile(durations, 0.5) * 1000:.1f} мс, "
+          f"p95 {percentile(durations, 0.95) * 1000:.1f} мс, макс {durations[-1] * 1000:.1f} мс")
+    print("Вызовы Bot API:")
+    for endpoint, count in sorted(request.calls.items(), key=lambda item: -item[1]):
+        print(f"  {count:6d}  {endpoint}")
 
 # -------------------------------------------------------------------
-# 13) ENTRY-POINT И ОБЪЕДИНЕНИЕ ВСЕХ ЭТАПОВ
+# 10) ENTRY-POINT И ОБЪЕДИНЕНИЕ ВСЕХ ЭТАПОВ
 # -------------------------------------------------------------------
-def main():
-    request = HTTPXRequest(connect_timeout=60.0, read_timeout=60.0)
-    app = Application.builder().token(TOKEN).request(request).build()
+def build_application(request: BaseRequest = None, application_class=SerializedApplication,
+                      rate_limit: bool = True) -> Application:
+    # request передаётся при воспроизведении записи (--replay): все вызовы идут в заглушку
+    updates_request = request
+    if request is None:
+        request = RoutingRequest(
+            interactive=build_http_request("INTERACTIVE"),
+            media=build_http_request("MEDIA"),
+            media_write_timeout=http_pool_timeout("MEDIA", "write")
+        )
+        updates_request = build_http_request("UPDATES")
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .request(request)
+        .get_updates_request(PollTrackingRequest(updates_request))
+        .application_class(application_class)
+        # Общий лимит держит SerializedApplication; здесь — только максимум задач в работе
+        .concurrent_updates(True)
+        .post_init(on_startup)
+    )
+    if rate_limit:
+        builder = builder.rate_limiter(OutboundRateLimiter())
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL).local_mode(BOT_API_LOCAL_MODE)
+        if BOT_API_FILE_URL:
+            builder = builder.base_file_url(BOT_API_FILE_URL)
+        logging.info("Bot API: %s (local_mode=%s)", BOT_API_URL, BOT_API_LOCAL_MODE)
+    app = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[
@@ -1874,7 +3311,258 @@ def main():
         ]
     )
 
+    # Команды архива обрабатываются раньше диалога (group=-1)
+    app.add_handler(CommandHandler("find", archive_find_command), group=-1)
+    app.add_handler(CommandHandler("resend", archive_resend_command), group=-1)
+    app.add_handler(CommandHandler("photos", archive_photos_command), group=-1)
+    app.add_handler(CommandHandler("search", archive_search_command), group=-1)
+    app.add_handler(CommandHandler("export", archive_export_command), group=-1)
+    app.add_handler(CallbackQueryHandler(archive_search_page, pattern=r"^search:\d+:\d+$"), group=-1)
+    if PROFILE_DIR:
+        profile_conversation(conv_handler)
+    if RECORD_UPDATES:
+        app.add_handler(TypeHandler(Update, record_update), group=-2)
     app.add_handler(conv_handler)
+    return app
+
+PREWARM_RENDERER = env_bool("PREWARM_RENDERER", True)
+
+_background_tasks = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    # post_init вызывается до Application.start(), поэтому задачи создаём
+    # напрямую в цикле и держим ссылку, пока они не завершатся
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def on_startup(application: Application):
+    logging.info("Бот готов к приёму апдейтов через %.0f мс после старта", (time.perf_counter() - STARTED_AT) * 1000)
+    if PREWARM_RENDERER:
+        # Прогрев идёт в пуле рендера, пока бот уже получает апдейты
+        start_background_task(run_in_render_pool(prewarm_renderer))
+    start_background_task(monitor_loop_lag())
+    if LOOP_BLOCK_THRESHOLD > 0:
+        start_loop_watchdog()
+    if SESSION_TTL_MIN > 0:
+        start_background_task(expire_idle_sessions(application))
+    if HEALTH_PORT:
+        start_background_task(start_health_server())
+
+def print_startup_report(top: int = 15):
+    """Разбор `python -X importtime`: во что обходится импорт bot.py и сборка приложения."""
+    import subprocess
+    import sys
+    code = (
+        "import time; t = time.perf_counter(); import bot; t_import = time.perf_counter() - t; "
+        "bot.build_application(); print(f'{t_import:.6f} {time.perf_counter() - t:.6f}')"
+    )
+    env = dict(os.environ, TOKEN=os.environ.get("TOKEN") or "0:startup-report")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        print(proc.stderr)
+        raise SystemExit(proc.returncode)
+    t_import, t_total = (float(v) for v in proc.stdout.split()[-2:])
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, len(indent) // 2, int(self_us), int(cumulative_us)))
+    print(f"Импорт bot.py: {t_import * 1000:.1f} мс")
+    print(f"Импорт + build_application(): {t_total * 1000:.1f} мс")
+    # importtime печатает вложенные импорты перед родителем: прямые импорты bot —
+    # это строки глубины 1 между предыдущим модулем верхнего уровня и самим bot
+    direct = []
+    bot_index = next((i for i, m in enumerate(modules) if m[0] == "bot" and m[1] == 0), None)
+    if bot_index is not None:
+        for m in reversed(modules[:bot_index]):
+            if m[1] == 0:
+                break
+            if m[1] == 1:
+                direct.append(m)
+    print(f"\nПрямые импорты bot.py (накопительно, топ-{top}):")
+    for name, _, _, cumulative_us in sorted(direct, key=lambda m: -m[3])[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} мс  {name}")
+    print(f"\nСамые медленные модули (собственное время, топ-{top}):")
+    for name, _, self_us, _ in sorted(modules, key=lambda m: -m[2])[:top]:
+        print(f"  {self_us / 1000:8.1f} мс  {name}")
+
+# Проверка рендера: фиксированные образцы прогоняются через генерацию таблицы
+# и наложение подписей, хэш пикселей сравнивается с эталоном, а медиана
+# времени — с бюджетом из RENDER_GOLDEN_PATH. Любая оптимизация рендера
+# проверяется командой `python bot.py --render-check` (её же запускает
+# pytest в tests/test_render.py); если вывод изменён намеренно, эталон
+# обновляется через `--render-check --update`.
+RENDER_GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_golden.json")
+RENDER_CHECK_RUNS = 5
+RENDER_BUDGET_FACTOR = 2.0   # бюджет = медиана при обновлении эталона × коэффициент
+
+def sample_opening(room, door_type, dimensions, comment="", **extra):
+    values = {
+        "room": room, "door_type": door_type, "dimensions": dimensions, "canvas": "800",
+        "dobor": "100 мм", "dobor_count": "2,5", "nalichniki": "5", "threshold": "Да",
+        "demontage": "Нет", "opening": "Левое", "comment": comment
+    }
+    values.update(extra)
+    return Opening(**values)
+
+SAMPLE_COMMENT_WORDS = [
+    "проверить", "стену", "на", "кривизну", "откосы", "штукатурить", "порог", "без",
+    "демонтажа", "старую", "дверь", "вывезти", "пол", "плитка", "ламинат", "уровень",
+    "заказчик", "просит", "доборы", "с", "двух", "сторон", "наличники", "белые",
+]
+
+RENDER_SAMPLES = {
+    "table_empty": {"client_name": "", "client_phone": "", "client_address": "", "openings": []},
+    "table_typical": {
+        "client_name": "Иван Петров",
+        "client_phone": "+7 912 000-00-00",
+        "client_address": "г. Пермь, ул. Ленина, д. 1, кв. 2",
+        "openings": [
+            sample_opening("Кухня", "Межкомнатная дверь", "2050 810 120", "Без порога"),
+            sample_opening("Спальня", "Межкомнатная дверь", "2040 800 100"),
+            sample_opening("Прихожая", "Входная дверь", "2070 900 250", "Старую дверь вывезти",
+                           dobor="---", dobor_count="---", nalichniki="---"),
+        ],
+    },
+    "table_long_comment": {
+        "client_name": "Ольга",
+        "client_phone": "89120000000",
+        "client_address": "Пермский край, Краснокамск, ул. Шоссейная, д. 15",
+        "openings": [
+            sample_opening("Зал", "Скрытая дверь", "2100 700 150", " ".join(["длинный комментарий"] * 15)),
+        ],
+    },
+    # Много проёмов с длинными комментариями — худший случай для подбора ширин
+    "table_many_long_comments": {
+        "client_name": "Ольга",
+        "client_phone": "89120000000",
+        "client_address": "Пермский край, Краснокамск, ул. Шоссейная, д. 15",
+        "openings": [
+            sample_opening(f"Комната {i}", "Межкомнатная дверь", "2050 810 120", " ".join(
+                SAMPLE_COMMENT_WORDS[(i * 7 + j * j) % len(SAMPLE_COMMENT_WORDS)] for j in range(30)
+            ))
+            for i in range(1, 21)
+        ],
+    },
+}
+RENDER_PHOTO_SAMPLES = {
+    "overlay_landscape": ((1280, 960), "Фото 1 проёма #1 (Кухня)"),
+    "overlay_portrait": ((960, 1280), "Фото 2 проёма #3 (Прихожая)"),
+}
+
+def sample_photo_bytes(size: tuple) -> bytes:
+    # Детерминированное «фото»: градиент без шума, чтобы JPEG был воспроизводим
+    from PIL import Image
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (gradient, gradient.rotate(90).resize(size), Image.new("L", size, 140)))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+def pixel_hash(buf: io.BytesIO) -> str:
+    # Хэш декодированных пикселей, а не байтов PNG: от настроек сжатия не зависит
+    from PIL import Image
+    img = Image.open(io.BytesIO(buf.getvalue()))
+    digest = hashlib.sha256(f"{img.mode}:{img.size}".encode("ascii"))
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+def render_table_preview(client_data: dict) -> io.BytesIO:
+    return generate_measurement_images(client_data)[1]
+
+def render_check_cases():
+    for name, client_data in RENDER_SAMPLES.items():
+        yield name, generate_measurement_image, (client_data,)
+    yield "table_preview", render_table_preview, (RENDER_SAMPLES["table_typical"],)
+    for name, (size, text) in RENDER_PHOTO_SAMPLES.items():
+        yield name, draw_photo_overlay, (sample_photo_bytes(size), text)
+    sheet_tiles = [(sample_photo_bytes(size), text) for size, text in RENDER_PHOTO_SAMPLES.values()] * 3
+    yield "contact_sheet", draw_contact_sheet, (sheet_tiles,)
+
+def run_render_check(update: bool = False) -> int:
+    import statistics
+    import PIL
+    prewarm_renderer()
+    golden = {}
+    if os.path.exists(RENDER_GOLDEN_PATH):
+        with open(RENDER_GOLDEN_PATH, encoding="utf-8") as f:
+            golden = json.load(f)
+    if not update and golden.get("pillow") not in (None, PIL.__version__):
+        print(f"Внимание: эталон снят на Pillow {golden['pillow']}, установлен {PIL.__version__}")
+    results = {}
+    failures = 0
+    for name, func, args in render_check_cases():
+        timings = []
+        for _ in range(RENDER_CHECK_RUNS):
+            started = time.perf_counter()
+            buf = func(*args)
+            timings.append((time.perf_counter() - started) * 1000)
+        median_ms = statistics.median(timings)
+        digest = pixel_hash(buf)
+        results[name] = {
+            "sha256": digest,
+            "median_ms": round(median_ms, 1),
+            "budget_ms": round(median_ms * RENDER_BUDGET_FACTOR + 5, 1),
+        }
+        expected = golden.get("cases", {}).get(name)
+        if update:
+            status = "обновлён"
+        elif expected is None:
+            status = "НЕТ ЭТАЛОНА"
+            failures += 1
+        elif expected["sha256"] != digest:
+            status = "ИЗОБРАЖЕНИЕ ИЗМЕНИЛОСЬ"
+            failures += 1
+        elif median_ms > expected["budget_ms"]:
+            status = f"МЕДЛЕННЕЕ БЮДЖЕТА {expected['budget_ms']} мс"
+            failures += 1
+        else:
+            status = "ok"
+        print(f"  {name:<26} {median_ms:8.1f} мс  {status}")
+    if update:
+        with open(RENDER_GOLDEN_PATH, "w", encoding="utf-8") as f:
+            json.dump({"pillow": PIL.__version__, "cases": results}, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"Эталон записан в {RENDER_GOLDEN_PATH}")
+        return 0
+    print("Рендер не изменился" if not failures else f"Расхождений: {failures}")
+    return 1 if failures else 0
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Бот замеров")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="показать разбор времени холодного старта и выйти")
+    parser.add_argument("--render-check", action="store_true",
+                        help="сравнить рендер образцов с эталоном (пиксели и время) и выйти")
+    parser.add_argument("--update", action="store_true",
+                        help="вместе с --render-check: перезаписать эталон")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="прогнать записанные апдейты (RECORD_UPDATES) через обработчики без сети и выйти")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="вместе с --replay: во сколько раз быстрее записи (0 — без пауз)")
+    parser.add_argument("--profile-report", nargs="?", const="", metavar="DIR",
+                        help="сводка по профилям из DIR (по умолчанию PROFILE_DIR или profiles) и выход")
+    args = parser.parse_args()
+    if args.replay:
+        asyncio.run(replay_updates(args.replay, args.speed))
+        return
+    if args.profile_report is not None:
+        print_profile_report(args.profile_report or PROFILE_DIR or "profiles")
+        return
+    if args.startup_report:
+        print_startup_report()
+        return
+    if args.render_check:
+        raise SystemExit(run_render_check(update=args.update))
+    app = build_application()
     app.run_polling()
 
 if __name__ == "__main__":
@@ -0,0 +1,30 @@
+# Обезличивание записанных апдейтов: телефоны маскируются и внутри текста,
+# надписи кнопок и размеры проёмов остаются как есть.
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bot  # noqa: E402
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("тел. 8 912 123-45-67", "ххх. 0 000 000-00-00"),
+    ("Иван 89121234567", "хххх 00000000000"),
+    ("+375291234567", "+000000000000"),
+    ("звонить после 18: +7 (912) 123-45-67, спросить Ольгу", "ххххххх ххххх 18: +0 (000) 000-00-00, хххххххх ххххх"),
+])
+def test_phone_masked_inside_text(text, expected):
+    assert bot.anonymize_text(text) == expected
+
+
+def test_phone_only_message_keeps_phone_format():
+    assert bot.anonymize_text("+7 (912) 123-45-67") == "80000000000"
+
+
+@pytest.mark.parametrize("text", ["2050 810 120", "2050х810х120", bot.DONE_TEXT, "Новый замер"])
+def test_dimensions_and_buttons_kept(text):
+    assert bot.anonymize_text(text) == text
@@ -0,0 +1,152 @@
+# Два замерщика одновременно завершают большие замеры: фото с подписями
+# рисуются в пуле рендера, и замеры обоих чатов отправляются параллельно,
+# а не один после другого.
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+from telegram import Update
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bot  # noqa: E402
+
+PHONE = "79000000000"
+OPENINGS = 3
+RENDER_DELAY = 0.5   # секунд на одну отрисовку фото
+
+
+def opening_steps(room: str) -> list:
+    return [room, "Межкомнатная дверь", "2050 810 120", "700", "100 мм", "2,5", "5",
+            "да", "нет", "Левое", "Комментарий"]
+
+
+class RecordingRequest(bot.ReplayRequest):
+    """Заглушка Bot API из --replay, которая ещё запоминает тексты по чатам."""
+
+    def __init__(self):
+        super().__init__()
+        self.texts = []   # (chat_id, text, время)
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        params = request_data.parameters if request_data else {}
+        if "text" in params:
+            self.texts.append((params["chat_id"], params["text"], time.monotonic()))
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+    def replied_at(self, chat_id: int, text: str):
+        return next((at for chat, sent, at in self.texts if chat == chat_id and text in sent), None)
+
+
+_update_id = [0]
+
+
+def make_update(app, user_id: int, text: str = None, photo: str = None, contact: str = None) -> Update:
+    _update_id[0] += 1
+    message = {
+        "message_id": _update_id[0], "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "U"},
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    if photo:
+        message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 1280, "height": 960}]
+    if contact:
+        message["contact"] = {"phone_number": contact, "first_name": "U", "user_id": user_id}
+    return Update.de_json({"update_id": _update_id[0], "message": message}, app.bot)
+
+
+async def wait_for(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def isolated_bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    monkeypatch.setattr(bot, "TOKEN", "123:abc")
+    monkeypatch.setattr(bot, "REPLAY_API_LATENCY", 0)
+    monkeypatch.setattr(bot, "ARCHIVE_DB_PATH", str(tmp_path / "archive.db"))
+    monkeypatch.setattr(bot, "_archive_conn", None)
+    monkeypatch.setattr(bot, "OVERLAY_CACHE", bot.OverlayCache(str(tmp_path / "overlay_cache"), 10 * 1024 * 1024))
+    monkeypatch.setattr(bot, "DELIVERY_MODE", "album")
+    monkeypatch.setitem(bot.ALLOWED_NUMBERS, PHONE, "Тест")
+    yield bot
+    if bot._archive_conn is not None:
+        bot._archive_conn.close()
+
+
+def test_two_chats_finish_large_measurements_concurrently(isolated_bot, monkeypatch):
+    rooms = {1: "Кухня", 2: "Спальня"}
+    renders = []   # (chat_id, начало, конец)
+    lock = threading.Lock()
+    original = bot.draw_photo_overlays
+
+    def slow_draw_photo_overlays(photo_bytes, texts):
+        # Большое фото: каждая отрисовка занимает поток пула на RENDER_DELAY
+        started = time.monotonic()
+        time.sleep(RENDER_DELAY)
+        images = original(photo_bytes, texts)
+        chat_id = next(chat for chat, room in rooms.items() if room in texts[0])
+        with lock:
+            renders.append((chat_id, started, time.monotonic()))
+        return images
+
+    monkeypatch.setattr(bot, "draw_photo_overlays", slow_draw_photo_overlays)
+
+    async def scenario():
+        request = RecordingRequest()
+        app = bot.build_application(request=request, rate_limit=False)
+        assert isinstance(app, bot.SerializedApplication)
+        await app.initialize()
+        await app.start()
+        try:
+            for user_id, room in rooms.items():
+                for step in ("/start", bot.LAUNCH_TEXT):
+                    await app.update_queue.put(make_update(app, user_id, text=step))
+                await app.update_queue.put(make_update(app, user_id, contact=PHONE))
+                steps = ["Новый замер", "Иван", "89120000000", "ул. Ленина, 1"]
+                for step in steps:
+                    await app.update_queue.put(make_update(app, user_id, text=step))
+                for number in range(1, OPENINGS + 1):
+                    if number > 1:
+                        await app.update_queue.put(make_update(app, user_id, text="Следующий проём"))
+                    for step in opening_steps(room):
+                        await app.update_queue.put(make_update(app, user_id, text=step))
+                    await app.update_queue.put(make_update(app, user_id, photo=f"chat{user_id}-photo{number}"))
+                    await app.update_queue.put(make_update(app, user_id, text=bot.DONE_TEXT))
+                await app.update_queue.put(make_update(app, user_id, text="Проверить и завершить"))
+            for user_id in rooms:
+                assert await wait_for(lambda: request.replied_at(user_id, "Проверьте замер"), 10)
+
+            # Оба замерщика нажимают «Завершить замер» одновременно
+            started = time.monotonic()
+            for user_id in rooms:
+                await app.update_queue.put(make_update(app, user_id, text="Завершить замер"))
+            done = "Замер успешно отправлен"
+            assert await wait_for(lambda: all(request.replied_at(user_id, done) for user_id in rooms), 15)
+            elapsed = time.monotonic() - started
+
+            # Каждый чат рисует OPENINGS фото; отрисовки по очереди заняли бы их суммарное время
+            assert len(renders) == OPENINGS * len(rooms)
+            assert elapsed < sum(end - start for _, start, end in renders)
+            spans = {chat: (min(s for c, s, _ in renders if c == chat), request.replied_at(chat, done))
+                     for chat in rooms}
+            # Рендер второго чата начался до того, как первый получил ответ, и наоборот
+            assert spans[1][0] < spans[2][1] and spans[2][0] < spans[1][1]
+        finally:
+            await app.stop()
+            await app.shutdown()
+
+    asyncio.run(scenario())
@@ -0,0 +1,57 @@
+# Локальный сервер Bot API (--local): фото читается с диска, если каталог
+# сервера доступен боту, и скачивается по HTTP, если нет.
+import asyncio
+import os
+import shutil
+import sys
+from types import SimpleNamespace
+
+import pytest
+from telegram import Bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bot  # noqa: E402
+
+
+class UnmountedRequest(bot.ReplayRequest):
+    """Сервер сохраняет файл в files_dir, но у бота этот каталог не смонтирован."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        result = await super().do_request(url, method, request_data, *args, **kwargs)
+        if url.endswith("/getFile"):
+            shutil.rmtree(self.files_dir)
+        return result
+
+
+@pytest.fixture
+def local_mode(tmp_path, monkeypatch):
+    files_dir = str(tmp_path / "bot_api")
+    monkeypatch.setattr(bot, "REPLAY_API_LATENCY", 0)
+    monkeypatch.setattr(bot, "BOT_API_LOCAL_MODE", True)
+    monkeypatch.setattr(bot, "BOT_API_SERVER_DIR", files_dir)
+    monkeypatch.setattr(bot, "BOT_API_FILES_DIR", files_dir)
+    return files_dir
+
+
+def download(request) -> bytes:
+    async def scenario():
+        async with Bot("123:abc", request=request, get_updates_request=bot.ReplayRequest()) as telegram_bot:
+            return await bot.download_photo_bytes(SimpleNamespace(bot=telegram_bot), "photo1")
+    return asyncio.run(scenario())
+
+
+def test_photo_read_from_disk(local_mode):
+    request = bot.ReplayRequest(local_mode)
+    photo = download(request)
+    assert photo == request.photo
+    assert "download" not in request.calls
+    assert os.path.isfile(os.path.join(local_mode, "photos", "photo1.jpg"))
+
+
+def test_photo_downloaded_when_not_on_disk(local_mode):
+    request = UnmountedRequest(local_mode)
+    photo = download(request)
+    assert photo == request.photo
+    assert request.calls["download"] == 1
@@ -0,0 +1,16 @@
+# Проверка рендера (--render-check) в составе тестов: образцы таблицы, превью,
+# подписей на фото и контактного листа совпадают с render_golden.json по
+# пикселям и укладываются в бюджет времени.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bot  # noqa: E402
+
+
+def test_render_matches_golden(monkeypatch, capsys):
+    monkeypatch.chdir(ROOT)
+    result = bot.run_render_check()
+    assert result == 0, capsys.readouterr().out